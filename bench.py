@@ -0,0 +1,571 @@
+'''
+This file is a benchmark suite for the hot paths of the simulation. It covers
+  - rv.<kind>          : rand_utils.generate_rv throughput, one RV per call,
+                         for every distribution kind
+  - static.<scale>     : simulate_static.game_static end to end, for each of
+                         the SCALES presets
+  - article_author     : simulate_static.article_author, per call
+  - event_articles     : simulate_static.event_articles, per call
+  - simulate_session   : SessionSimulator.simulate_session, timed over every
+                         eligible user for one day (i.e., per-day throughput)
+  - storage.<layout>   : a rollup scan (one team-day aggregate per op) over the
+                         same synthetic pageviews stored as Pageview rows
+                         (pageview) and compacted to PageviewDay rows (daily);
+                         each also records the database size per pageview
+  - startup.<command>  : the time for a fresh interpreter to start cli.py and
+                         import everything <command> needs, checked against
+                         the budgets in STARTUP_BUDGETS, which are multiples
+                         of reference imports timed in the same run (so that
+                         they hold on slower machines)
+
+It also has checks (see CHECKS), which pass or fail rather than time
+  - determinism        : simulates the same small game twice, with the same
+                         seeds, then once more a day at a time (as service.py
+                         runs it, one run_batch per day), and compares the
+                         pageviews (and so the paywall hits) and conversions
+                         (UserStrategy rows) of the three runs
+  - stream_sql         : streams a column of mixed types and a nullable
+                         column with models.stream_sql, over several chunks
+
+Every benchmark is seeded, and runs against a scratch database in a temporary
+directory, so game.db is never touched. Each result records the best time per
+operation over several repeats, which is the least noisy statistic to compare.
+
+Usage
+    python bench.py run                      # print results
+    python bench.py run --save               # ... and store them as the baseline
+    python bench.py compare                  # re-run, and flag slowdowns
+    python bench.py compare --threshold 0.5  # only flag slowdowns above 50%
+
+    python bench.py startup                  # only check CLI startup budgets
+    python bench.py check                    # only run the checks
+
+compare exits with a non-zero status if any benchmark is slower than the
+baseline by more than the threshold (25% by default), and run, compare and
+startup all exit with a non-zero status if a command exceeds its startup
+budget, and check if any check fails.
+'''
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import models as m
+import popularity
+import rand_utils
+import simulate_static as ss
+import simulate_dynamic as sd
+import views
+
+BASELINE_FILE = 'bench_baseline.json'
+
+# (n_authors, n_users, n_days) for each game_static preset
+SCALES = {'small'  : {'n_authors': 10, 'n_users': 100,  'n_days': 10},
+          'medium' : {'n_authors': 25, 'n_users': 500,  'n_days': 30},
+          'large'  : {'n_authors': 50, 'n_users': 2000, 'n_days': 60}}
+
+DEFAULT_SCALES = ['small', 'medium']
+
+# Imports timed in a fresh interpreter alongside the startup benchmarks, so
+# that startup budgets scale with the machine: a bare interpreter, and the
+# dependencies every simulation command needs anyway
+STARTUP_REFERENCES = {'python' : 'pass',
+                      'core'   : 'import numpy, sqlalchemy.orm'}
+
+# Time budget for a fresh interpreter to start cli.py and import everything
+# each command needs, as a multiple of a reference. --help and draw_db should
+# never import the simulation's heavy dependencies, and the other commands
+# nothing much beyond them (eg: not pandas)
+STARTUP_BUDGETS = {'--help'      : ('python', 6),
+                   'draw_db'     : ('python', 6),
+                   'create_db'   : ('core',   1.75),
+                   'create_game' : ('core',   1.75),
+                   'create_team' : ('core',   1.75),
+                   'seed_pvs'    : ('core',   1.75)}
+
+# Pageviews written by the storage benchmark, over (teams, users, articles, days)
+STORAGE_PVS   = 200000
+STORAGE_SHAPE = (4, 2000, 3000, 60)
+
+# Arguments passed to generate_rv for every distribution kind
+RV_KINDS = {'uniform'     : {},
+            'exponential' : {},
+            'normal'      : {},
+            'poisson'     : {'lam': 7},
+            'dirichlet'   : {'alpha': np.ones(12)*0.3},
+            'choice'      : {'l': list(range(12)), 'p': [1]*12},
+            'name'        : {},
+            'ipv4'        : {},
+            'user_agent'  : {}}
+
+# ------------------------
+# -  Section 1; helpers  -
+# ------------------------
+
+class RandomStream(rand_utils.Rand_utils_mixin):
+    '''
+    A bare object with its own randomization path, used to benchmark
+    generate_rv outside of any ORM object
+    '''
+
+    def __init__(self, seed):
+        self.seed         = seed
+        self.random_state = None
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Silences the progress output of the code being benchmarked
+    '''
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+@contextlib.contextmanager
+def scratch_db():
+    '''
+    Points models at an empty database in a temporary directory for the
+    duration of the block
+    '''
+    old_engine = m.engine
+
+    with tempfile.TemporaryDirectory() as d:
+        engine = m.use_database(f'sqlite:///{os.path.join(d, "bench.db")}')
+        m.create_db()
+        try:
+            yield
+        finally:
+            engine.dispose()
+            m.engine = old_engine
+
+def measure(f, n_ops, repeat):
+    '''
+    Calls f() repeat times; f should perform n_ops operations. Returns the
+    best and mean time per operation, in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        t_0 = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - t_0)/n_ops)
+
+    return {'best_s'    : min(times),
+            'mean_s'    : sum(times)/len(times),
+            'ops_per_s' : 1/min(times),
+            'n_ops'     : n_ops,
+            'repeat'    : repeat}
+
+def build_game(n_authors=10, n_users=100, n_days=10, n_teams=2, seed=123):
+    '''
+    Generates a game in the current database, with n_teams teams, and
+    returns its id
+    '''
+    with quiet():
+        game_id = ss.game_static('Benchmark', seed, n_days, n_days, n_authors, n_users)
+
+    for i in range(n_teams):
+        sd.create_team(game_id, f'Team {i}', seed + i + 1)
+
+    return game_id
+
+# ---------------------------
+# -  Section 2; benchmarks  -
+# ---------------------------
+
+def bench_rv(repeat):
+    out = {}
+    for kind, kwargs in RV_KINDS.items():
+        stream = RandomStream(seed=0)
+        n_ops  = 200
+        out[f'rv.{kind}'] = measure(lambda: [stream.generate_rv(kind, **kwargs) for _ in range(n_ops)],
+                                    n_ops, repeat)
+    return out
+
+def bench_static(scales, repeat):
+    out = {}
+    for scale in scales:
+        params = SCALES[scale]
+
+        def run():
+            with scratch_db(), quiet():
+                ss.game_static('Benchmark', 123, params['n_days'], params['n_days'],
+                               params['n_authors'], params['n_users'])
+
+        out[f'static.{scale}'] = measure(run, 1, repeat)
+        out[f'static.{scale}'].update(params)
+    return out
+
+def bench_generation(repeat):
+    '''
+    Micro-benchmarks for article_author and event_articles, run against a
+    small generated game
+    '''
+    out = {}
+    with scratch_db():
+        game_id = build_game(n_teams=0)
+
+        with m.Session() as db:
+            # Load the whole game, so that lazy loading isn't timed
+            game   = m.Game.load(db, game_id)
+            topics = game.topics
+            events = views.load_events(db, game_id)
+
+            weights = ss.author_weights(game)
+
+            n_ops = 100
+            out['article_author'] = measure(lambda: [ss.article_author(topics[i % len(topics)], weights)
+                                                            for i in range(n_ops)],
+                                            n_ops, repeat)
+
+            n_ops = min(len(events), 500)
+            out['event_articles'] = measure(lambda: [ss.event_articles(e, e.start, game)
+                                                            for e in events[:n_ops]],
+                                            n_ops, repeat)
+
+            # Don't keep the random state changes
+            db.rollback()
+    return out
+
+def bench_session(repeat):
+    '''
+    Times simulate_session over every eligible user on one day; the
+    pageviews it creates are rolled back after each repeat
+    '''
+    out = {}
+    with scratch_db():
+        game_id = build_game()
+
+        with m.Session() as db:
+            game       = m.Game.load(db, game_id)
+            day        = game.n_days - 1
+            users      = views.load_users(db, game_id, day)
+            articles   = views.load_articles(db, game_id, end=day)
+            strategies = views.load_strategies(db, game_id)
+            author_ids = sorted(views.load_authors(db, game_id))
+
+            def run():
+                sd.pv_cache.teams.clear()
+                sd.pv_scores.reset()
+                popularities = {t.id: popularity.Popularity.from_team(t, author_ids) for t in game.teams}
+                batch = sd.PageviewBatch()
+                for user in users:
+                    sd.SessionSimulator(user, game, batch, popularities=popularities) \
+                        .simulate_session(db, day, list(articles), True)
+                batch.finalize(db, game.teams, day, strategies, {}, popularities)
+                db.rollback()
+
+            out['simulate_session'] = measure(run, len(users), repeat)
+            out['simulate_session']['users_per_day'] = len(users)
+    return out
+
+def bench_storage(repeat):
+    '''
+    Writes the same synthetic pageviews in each layout, then records the
+    size of each database and times a rollup-style scan of every team-day
+    '''
+    import sqlalchemy as sa
+
+    import compaction
+
+    # Sessions of one or more pageviews, as generate_pvs writes them
+    n_teams, n_users, n_articles, n_days = STORAGE_SHAPE
+    rng        = np.random.default_rng(0)
+    n_sessions = STORAGE_PVS // 4
+    session    = np.repeat(np.arange(n_sessions), 1 + rng.poisson(3, n_sessions))[:STORAGE_PVS]
+    n_pvs      = len(session)
+    cols = {'team_id'    : rng.integers(1, n_teams + 1, n_sessions)[session],
+            'user_id'    : rng.integers(1, n_users + 1, n_sessions)[session],
+            'article_id' : rng.integers(1, n_articles + 1, n_pvs),
+            'day'        : np.sort(rng.integers(0, n_days, n_sessions))[session],
+            'duration'   : rng.gamma(2, 2, n_pvs),
+            'ads_seen'   : rng.integers(0, 7, n_sessions)[session],
+            'paywall'    : rng.uniform(size=n_pvs) < 0.3,
+            'converted'  : rng.uniform(size=n_pvs) < 0.01}
+    rows = [dict(zip(cols, r)) for r in zip(*[c.tolist() for c in cols.values()])]
+
+    def pageview(engine):
+        pv = m.Pageview
+        pv.__table__.create(engine)
+        with engine.begin() as conn:
+            conn.execute(sa.insert(pv), [dict(user_id=r['user_id'], article_id=r['article_id'], team_id=r['team_id'],
+                                              day=r['day'], duration=int(r['duration']), ads_seen=r['ads_seen'],
+                                              saw_paywall=r['paywall'], converted=r['converted']) for r in rows])
+        return sa.select(pv.team_id, sa.func.count(sa.distinct(pv.user_id)), sa.func.count(),
+                         sa.func.sum(pv.ads_seen), sa.func.sum(sa.cast(pv.saw_paywall, sa.Integer))) \
+                 .where(pv.day == sa.bindparam('day')).group_by(pv.team_id)
+
+    def daily(engine):
+        pageview(engine)
+        pd = m.PageviewDay
+        for table in [m.Team, pd]:
+            table.__table__.create(engine)
+        with engine.begin() as conn:
+            conn.execute(sa.insert(m.Team), [dict(id=t, game_id=1, seed=t) for t in range(1, n_teams + 1)])
+        with m.Session(bind=engine) as db:
+            compaction.compact_before(db, 1, n_days)
+            db.commit()
+        with engine.begin() as conn:
+            conn.execute(sa.text('VACUUM'))
+        return sa.select(pd.team_id, sa.func.count(), sa.func.sum(pd.pageviews),
+                         sa.func.sum(pd.ads_seen), sa.func.sum(pd.paywall_hits)) \
+                 .where(pd.day == sa.bindparam('day')).group_by(pd.team_id)
+
+    out = {}
+    for name, build in [('pageview', pageview), ('daily', daily)]:
+        with tempfile.TemporaryDirectory() as d:
+            path   = os.path.join(d, 'storage.db')
+            engine = sa.create_engine(f'sqlite:///{path}')
+            q      = build(engine)
+
+            def scan():
+                with engine.connect() as conn:
+                    for day in range(n_days):
+                        conn.execute(q, {'day': day}).fetchall()
+
+            out[f'storage.{name}'] = measure(scan, n_days, repeat)
+            out[f'storage.{name}']['bytes_per_pv'] = os.path.getsize(path) / len(rows)
+            engine.dispose()
+    return out
+
+def bench_startup(repeat):
+    '''
+    Times cli.py startup in a fresh interpreter for every command in
+    STARTUP_BUDGETS; commands are resolved (i.e., their modules imported)
+    but not run. Each run of a command follows a run of its reference, so
+    that both are timed under the same load, and the command's budget_s is
+    its multiple of the reference's best time
+    '''
+    here  = os.path.dirname(os.path.abspath(__file__))
+    times = {f'reference.{name}': [] for name in STARTUP_REFERENCES}
+
+    def timed(code):
+        t_0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=here, check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - t_0
+
+    budgets = {}
+    for command, (reference, ratio) in STARTUP_BUDGETS.items():
+        if command == '--help':
+            code = "import sys; sys.argv = ['cli.py', '--help']; import cli; cli.main()"
+        else:
+            code = f"import cli; cli.resolve('{command}')"
+
+        reference_times, times[command] = [], []
+        for _ in range(repeat):
+            reference_times.append(timed(STARTUP_REFERENCES[reference]))
+            times[command].append(timed(code))
+        times[f'reference.{reference}'].extend(reference_times)
+        budgets[command] = {'reference' : reference,
+                            'budget_x'  : ratio,
+                            'budget_s'  : ratio * min(reference_times)}
+
+    out = {}
+    for name, t in times.items():
+        out[f'startup.{name}'] = {'best_s'    : min(t),
+                                  'mean_s'    : sum(t)/len(t),
+                                  'ops_per_s' : 1/min(t),
+                                  'n_ops'     : 1,
+                                  'repeat'    : len(t)}
+        out[f'startup.{name}'].update(budgets.get(name, {}))
+    return out
+
+def over_budget(results):
+    '''
+    Returns the names of the startup benchmarks that exceeded their budget
+    '''
+    return [name for name, r in results.items()
+                    if 'budget_s' in r and r['best_s'] > r['budget_s']]
+
+def simulation_rows(seed=123, n_days=10, days_per_run=None):
+    '''
+    Generates a small game in a scratch database, simulates all of its days
+    (in one generate_pvs, or in runs of days_per_run days through
+    service.run_batch), and returns its pageviews and its UserStrategy
+    rows, in insertion order
+    '''
+    import sqlalchemy as sa
+
+    import service
+
+    pv, us = m.Pageview, m.UserStrategy
+
+    with scratch_db():
+        game_id = build_game(n_days=n_days, seed=seed)
+        with quiet():
+            if days_per_run is None:
+                sd.generate_pvs(game_id, 0, n_days)
+            else:
+                database = {'url': m.get_engine().url.render_as_string(hide_password=False)}
+                for start in range(0, n_days, days_per_run):
+                    out = service.run_batch(game_id, [], start, min(start + days_per_run, n_days), database)
+                    if out['error'] is not None:
+                        raise RuntimeError(out['error'])
+
+        with m.Session() as db:
+            pvs = db.execute(sa.select(pv.team_id, pv.user_id, pv.article_id, pv.day, pv.duration,
+                                       pv.ads_seen, pv.saw_paywall, pv.converted).order_by(pv.id)).fetchall()
+            conversions = db.execute(sa.select(us.user_id, us.strategy_id, us.start_day)
+                                       .order_by(us.id)).fetchall()
+
+    return {'pageviews': pvs, 'user_strategy': conversions}
+
+def check_determinism(seed=123, n_days=40):
+    '''
+    Simulates the same game twice with the same seeds, then once more one
+    day per run; returns the failures: the runs whose rows differ from the
+    first run's, with the tables that differ. n_days should go past
+    compaction.TRAILING_DAYS, so that later runs resume from a compacted
+    history
+    '''
+    first = simulation_rows(seed, n_days)
+    runs  = {'same seeds'      : simulation_rows(seed, n_days),
+             'one day per run' : simulation_rows(seed, n_days, days_per_run=1)}
+    return [f'{name}: {", ".join(t for t in first if rows[t] != first[t])} differ from the first run'
+                for name, rows in runs.items() if rows != first]
+
+def check_stream_sql():
+    '''
+    Streams, two rows per chunk, a column whose values widen from chunk to
+    chunk (integers, then NULLs only, then floats, then text) and a column
+    that is NULL in its first chunks; returns the failures
+    '''
+    import pandas as pd
+    import sqlalchemy as sa
+
+    values = [(1, None), (2, None), (None, None), (None, None), (2.5, 1), (3, 2), ('text', None)]
+
+    with scratch_db():
+        with m.get_engine().begin() as conn:
+            conn.execute(sa.text('CREATE TABLE mixed (id INTEGER, x, n INTEGER)'))
+            conn.execute(sa.text('INSERT INTO mixed VALUES (:id, :x, :n)'),
+                         [{'id': i, 'x': x, 'n': n} for i, (x, n) in enumerate(values)])
+
+        try:
+            chunks = list(m.stream_sql('SELECT x, n FROM mixed ORDER BY id', chunksize=2))
+        except Exception as e:
+            return [f'stream_sql raised {type(e).__name__}: {e}']
+
+    failures = []
+    streamed = [tuple(None if pd.isna(v) else v for v in row)
+                    for c in chunks for row in c.itertuples(index=False)]
+    if streamed != values:
+        failures.append(f'stream_sql returned {streamed}, rather than {values}')
+
+    dtypes = [str(c['x'].dtype) for c in chunks]
+    if dtypes != ['Int64', 'Int64', 'Float64', 'object']:
+        failures.append(f'stream_sql gave column x the dtypes {dtypes}')
+
+    return failures
+
+CHECKS = {'determinism' : check_determinism,
+          'stream_sql'  : check_stream_sql}
+
+def run_all(scales, repeat):
+    results = {}
+    results.update(bench_startup(repeat))
+    results.update(bench_rv(repeat))
+    results.update(bench_generation(repeat))
+    results.update(bench_session(repeat))
+    results.update(bench_storage(repeat))
+    results.update(bench_static(scales, max(1, repeat//2)))
+    return results
+
+# ---------------------------
+# -  Section 3; reporting   -
+# ---------------------------
+
+def environment():
+    return {'date'     : datetime.datetime.now().isoformat(),
+            'python'   : sys.version.split()[0],
+            'platform' : platform.platform(),
+            'numpy'    : np.__version__}
+
+def print_results(results, baseline=None):
+    print(f'{"benchmark":<24}{"best (ms/op)":>14}{"ops/s":>12}{"vs baseline":>14}')
+    for name, r in results.items():
+        change = ''
+        if baseline is not None and name in baseline:
+            change = f'{r["best_s"]/baseline[name]["best_s"] - 1:+.1%}'
+        budget = ''
+        if 'budget_s' in r:
+            budget = f'  budget {r["budget_s"]*1000:.1f} ({r["budget_x"]:g}x {r["reference"]})'
+        print(f'{name:<24}{r["best_s"]*1000:>14.3f}{r["ops_per_s"]:>12.1f}{change:>14}{budget}')
+
+def compare(results, baseline, threshold):
+    '''
+    Returns the names of the benchmarks that are more than threshold
+    (a fraction) slower than the baseline
+    '''
+    return [name for name, r in results.items()
+                    if name in baseline and r['best_s'] > baseline[name]['best_s']*(1 + threshold)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulation benchmark suite')
+    parser.add_argument('command', choices=['run', 'compare', 'startup', 'check'])
+    parser.add_argument('--scales', default=','.join(DEFAULT_SCALES),
+                        help=f'Comma-separated game_static presets, from {", ".join(SCALES)}')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeats per benchmark')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Slowdown (as a fraction) above which compare fails')
+    args = parser.parse_args()
+
+    scales  = [s for s in args.scales.split(',') if s]
+    failed  = False
+
+    if args.command == 'check':
+        for name, check in CHECKS.items():
+            failures = check()
+            print(f'{name:<24}{"failed" if failures else "ok"}')
+            for f in failures:
+                print(f'  {f}')
+            failed = failed or bool(failures)
+        if failed:
+            exit(1)
+        return
+
+    if args.command == 'startup':
+        results = bench_startup(args.repeat)
+        print_results(results)
+
+    elif args.command == 'run':
+        results = run_all(scales, args.repeat)
+        print_results(results)
+        if args.save:
+            with open(args.baseline, 'w') as f:
+                json.dump({'environment': environment(), 'results': results}, f, indent=2)
+            print(f'Saved baseline to {args.baseline}')
+
+    else:
+        results = run_all(scales, args.repeat)
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        print_results(results, baseline)
+
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print(f'Slower than baseline by more than {args.threshold:.0%}: {", ".join(slower)}')
+            failed = True
+
+    slow_startup = over_budget(results)
+    if slow_startup:
+        print(f'Over startup budget: {", ".join(slow_startup)}')
+        failed = True
+
+    if failed:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+This file maintains the candidate articles of the dynamic simulation: for each
+topic, the articles users might see on a given day (those published in the
+longtail window of simulate_dynamic.generate_pvs), ordered by author quality
+and then recency.
+
+Without an index, every session scores every article of the window, and the
+window spans weeks whenever a long-lived event is still active. But a user only
+clicks articles whose score beats a cutoff (see SessionSimulator.simulate_session),
+and within a topic, scores only vary with the author's quality and popularity.
+So for each of a user's topics, only a prefix of the topic's articles can be
+clicked - and none at all for topics the user has little interest in.
+CandidateIndex.for_user returns those articles
+  - with per_topic=None, it returns every article that full scoring could
+    click, so sessions click the same articles as they would over the whole
+    window (in a different random order)
+  - with per_topic=N, it returns at most the N best articles of each topic,
+    trading recall (the share of clickable articles returned) for speed;
+    see recall below. generate_pvs measures the recall of each day, and
+    on days it falls below a bound (MIN_RECALL by default), scores every
+    clickable article instead
+
+The index is maintained incrementally: as days advance, it only loads the
+articles of the new days, and drops those that fell out of the window.
+'''
+
+import bisect
+
+import views
+
+# Smallest recall at which generate_pvs keeps the per-topic limit of a day
+MIN_RECALL = 0.9
+
+class CandidateIndex:
+    '''
+    The articles of a window of days, by topic; see the top of this file
+      - per_topic : the maximum number of candidates of each topic returned
+                    by for_user (None for no maximum)
+      - start, end: the window currently indexed (inclusive)
+    '''
+
+    def __init__(self, per_topic=None):
+        self.per_topic = per_topic
+        self.start     = None
+        self.end       = None
+        # topic id -> articles, by decreasing quality, then most recent first
+        self.topics    = {}
+        # topic id -> negated author qualities of those articles (increasing)
+        self.keys      = {}
+
+    def __len__(self):
+        return sum(len(a) for a in self.topics.values())
+
+    def __repr__(self):
+        return f'<CandidateIndex days {self.start}-{self.end}, {len(self)} articles>'
+
+    def update(self, db, game_id, start, end, authors=None):
+        '''
+        Moves the index to the articles published between days start and end
+        (inclusive), loading only the articles it doesn't hold yet. authors
+        is the result of views.load_authors
+        '''
+        changed = set()
+        if (self.end is None) or (start < self.start) or (end < self.end) or (start > self.end + 1):
+            # The new window doesn't extend the current one; start over
+            self.topics, self.keys = {}, {}
+            new = views.load_articles(db, game_id, start, end, authors)
+        else:
+            if start > self.start:
+                for t, articles in self.topics.items():
+                    if any(a.day < start for a in articles):
+                        self.topics[t] = [a for a in articles if a.day >= start]
+                        changed.add(t)
+            new = views.load_articles(db, game_id, self.end + 1, end, authors) if end > self.end else []
+
+        self.start, self.end = start, end
+
+        for article in new:
+            self.topics.setdefault(article.topic_id, []).append(article)
+            changed.add(article.topic_id)
+        for t in changed:
+            self.topics[t].sort(key=lambda a: (-a.author.quality, -a.day, a.id))
+            self.keys[t] = [-a.author.quality for a in self.topics[t]]
+
+        return len(new)
+
+    def for_user(self, interests, cutoff, bonus=0, limited=True):
+        '''
+        Returns the articles a user could click: those whose score (see
+        SessionSimulator.simulate_session) can reach cutoff, given the user's
+        topic interests, and bonus, an upper bound on the popularity part of
+        the score (see simulate_dynamic.POPULARITY_WEIGHT). At most
+        per_topic articles are returned per topic, unless limited is False
+        '''
+        from simulate_dynamic import INTEREST_WEIGHT, QUALITY_WEIGHT
+
+        # Topics in id order, so that the articles returned only depend on
+        # the window, not on how the index got to it
+        out = []
+        for t, keys in sorted(self.keys.items()):
+            # Smallest quality that can reach the cutoff on this topic
+            min_quality = (cutoff - interests.get(t, 0) * INTEREST_WEIGHT - bonus) / QUALITY_WEIGHT
+            n = bisect.bisect_right(keys, -min_quality)
+            if limited and (self.per_topic is not None):
+                n = min(n, self.per_topic)
+            out.extend(self.topics[t][:n])
+        return out
+
+def recall(index, users, cutoff, bonus=0):
+    '''
+    Returns the share of the articles users could click (as found with
+    per_topic=None) that index returns; 1 unless index limits per_topic
+    '''
+    n_full = n_index = 0
+    for user in users:
+        n_full  += len(index.for_user(user.interests, cutoff, bonus, limited=False))
+        n_index += len(index.for_user(user.interests, cutoff, bonus))
+    return n_index / n_full if n_full else 1.0
@@ -1,22 +1,109 @@
 import argparse
-from models import create_db
-from utils import draw_db
-
-from simulate import seed, generate_pvs
+import contextlib
+import importlib
+import json
 
+# Each command maps to the module and function that implement it, and to a
+# function that calls it with the parsed arguments. Modules are only imported
+# when their command runs, so that --help or draw_db don't pay for pandas,
+# numpy, SQLAlchemy or Faker
 commands = {
-    'create_db': lambda args: create_db(),
-    'create_game': lambda args: game_static(args),
-    'seed_pvs': lambda args: generate_pvs(),
-    'draw_db': lambda args: draw_db()
+    'create_db'       : ('models',           'create_db',       lambda f, args: f()),
+    'create_game'     : ('simulate_static',  'game_static',     lambda f, args: f(args.name, args.seed, args.n_days,
+                                                                                  args.n_days_p0, args.n_authors,
+                                                                                  args.n_users, args.user_chunk_size,
+                                                                                  args.sparse_top_k, args.sparse_threshold)),
+    'create_team'     : ('simulate_dynamic', 'create_team',     lambda f, args: f(args.game_id, args.name, args.seed)),
+    'add_strategy'    : ('simulate_dynamic', 'add_strategy',    lambda f, args: f(args.team_id, args.cost, args.ads,
+                                                                                  args.free_pvs, args.segment,
+                                                                                  args.priority)),
+    'seed_pvs'        : ('simulate_dynamic', 'generate_pvs',    lambda f, args: f(args.game_id, args.start, args.end,
+                                                                                  args.candidates_per_topic, args.min_recall)),
+    'rebuild_rollups' : ('rollups',          'rebuild_rollups', lambda f, args: f(args.game_id)),
+    'compact_pvs'     : ('compaction',       'compact_game',    lambda f, args: f(args.game_id)),
+    'export_parquet'  : ('export',           'export_game',     lambda f, args: f(args.game_id, args.output or 'export')),
+    'snapshot'        : ('snapshot',         'write_snapshot',  lambda f, args: f(args.game_id, args.output or
+                                                                                  f'snapshots/game_{args.game_id}')),
+    'draw_db'         : ('utils',            'draw_db',         lambda f, args: f())
 }
 
+def resolve(command):
+    '''
+    Imports the module implementing a command, and returns its function
+    '''
+    module, function, _ = commands[command]
+    return getattr(importlib.import_module(module), function)
+
 parser = argparse.ArgumentParser(description='Media Analytics Simulation Game Helper')
 parser.add_argument('command', help='Command to execute', choices=commands.keys())
+parser.add_argument('--name', default='Test Game', help='Name of the game or team to create')
+parser.add_argument('--seed', type=int, default=123, help='Seed of the game or team to create')
+parser.add_argument('--n-days', type=int, default=60, help='Number of days in the game')
+parser.add_argument('--n-days-p0', type=int, default=30, help='Number of days in the initial period')
+parser.add_argument('--n-authors', type=int, default=50, help='Number of authors in the game')
+parser.add_argument('--n-users', type=int, default=1000, help='Number of users in the game')
+parser.add_argument('--user-chunk-size', type=int, default=1000, help='Users generated and saved at a time')
+parser.add_argument('--sparse-top-k', type=int, default=None, help='Only store the top k expertises and affinities '
+                                                                   'of each author and user')
+parser.add_argument('--sparse-threshold', type=float, default=None, help='Only store expertises and affinities above '
+                                                                         'this threshold')
+parser.add_argument('--game-id', type=int, default=1, help='Game to add a team to or simulate')
+parser.add_argument('--team-id', type=int, default=1, help='Team to add a strategy to')
+parser.add_argument('--cost', type=float, default=9, help='Subscription price of the strategy to add')
+parser.add_argument('--ads', type=int, default=3, help='Ads per pageview of the strategy to add')
+parser.add_argument('--free-pvs', type=int, default=12, help='Free pageviews of the strategy to add')
+parser.add_argument('--segment', type=json.loads, default=None, help='Segment of the strategy to add, as JSON, '
+                                                                    'eg: \'{"age": ["15 to 24"]}\'')
+parser.add_argument('--priority', type=int, default=0, help='Priority of the strategy to add')
+parser.add_argument('--start', type=int, default=0, help='First day to simulate')
+parser.add_argument('--end', type=int, default=None, help='Day to stop simulating at (default: end of the initial period)')
+parser.add_argument('--candidates-per-topic', type=int, default=None, help='Only score the best N articles of '
+                                                                              'each topic in sessions (default: all)')
+parser.add_argument('--min-recall', type=float, default=None, help='With --candidates-per-topic, score every '
+                                                                     'clickable article on days the limit returns less '
+                                                                     'than this share of them (default: 0.9)')
+parser.add_argument('--output', default=None, help='Directory to export or snapshot a game to '
+                                                   '(default: export/ or snapshots/game_<id>/)')
+parser.add_argument('--sharded', action='store_true', help='Keep each game in its own database shard (see '
+                                                            'shards.py); create_db then creates the catalog')
+parser.add_argument('--progress', choices=['console', 'none'], default='console',
+                    help='Where to report progress (default: the console)')
+parser.add_argument('--progress-log', metavar='PATH', help='Also append progress events to PATH, as JSON lines')
+parser.add_argument('--profile', metavar='PATH', help='Write a JSON profiling report of the command to PATH')
+
+def main():
+    args = parser.parse_args()
+    if not args.command in commands:
+        print(f'Invalid command {args.command}')
+        exit(1)
+
+    if args.profile:
+        import profiling
+        profiling.enable()
+
+    if (args.progress == 'console') or args.progress_log:
+        import progress
+        if args.progress == 'console':
+            progress.add_sink(progress.ConsoleSink())
+        if args.progress_log:
+            progress.add_sink(progress.JsonLinesSink(args.progress_log))
+
+    f       = resolve(args.command)
+    context = contextlib.nullcontext()
+    if args.sharded:
+        import shards
+        if args.command == 'create_db':
+            f = shards.create_catalog
+        elif args.command == 'create_game':
+            f = shards.create_game
+        else:
+            context = shards.routed(args.game_id)
+
+    with context:
+        commands[args.command][2](f, args)
 
-args = parser.parse_args()
-if not args.command in commands:
-    print(f'Invalid command {args.command}')
-    exit(1)
+    if args.profile:
+        profiling.write_report(args.profile, command=args.command)
 
-commands[args.command](args)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
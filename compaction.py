@@ -0,0 +1,104 @@
+'''
+This file compacts old pageviews. The simulation only reads the pageviews of
+the last TRAILING_DAYS days (a user's recently seen articles and their number
+of recent sessions, see simulate_dynamic.SessionSimulator); older days are only
+ever aggregated, by rollups and exports. So once a day leaves that window, its
+pageviews are replaced by one PageviewDay row per team, user and day, holding
+their counts and totals.
+
+generate_pvs compacts days as they leave the window; compact_game compacts
+every eligible day of a game, eg: one simulated before compaction existed.
+Compacting is idempotent: compacting a day again merges any new pageviews into
+the day's existing PageviewDay rows.
+'''
+
+import sqlalchemy as sa
+
+import models as m
+
+# Number of days of pageviews the simulation reads, and so keeps uncompacted
+TRAILING_DAYS = 30
+
+def compact_day(db, game_id, day):
+    '''
+    Compacts the pageviews of a game on a single day into PageviewDay rows.
+    Returns the number of pageviews compacted; the caller commits
+    '''
+
+    team_ids = sa.select(m.Team.id).where(m.Team.game_id == game_id)
+    pv, pd   = m.Pageview, m.PageviewDay
+
+    n_pvs = db.execute(sa.select(sa.func.count())
+                         .where(pv.day == day)
+                         .where(pv.team_id.in_(team_ids))).scalar()
+    if not n_pvs:
+        return 0
+
+    # Merge the day's pageviews with any rows it was already compacted to
+    rows = sa.union_all(
+        sa.select(pv.team_id, pv.user_id,
+                  sa.literal(1).label('pageviews'),
+                  pv.duration,
+                  pv.ads_seen,
+                  sa.cast(pv.saw_paywall, sa.Integer).label('paywall_hits'),
+                  sa.cast(pv.converted, sa.Integer).label('conversions'))
+          .where(pv.day == day)
+          .where(pv.team_id.in_(team_ids)),
+        sa.select(pd.team_id, pd.user_id, pd.pageviews, pd.duration, pd.ads_seen,
+                  pd.paywall_hits, pd.conversions)
+          .where(pd.day == day)
+          .where(pd.team_id.in_(team_ids))).subquery()
+
+    q = sa.select(rows.c.team_id, rows.c.user_id,
+                  sa.func.sum(rows.c.pageviews),
+                  sa.func.coalesce(sa.func.sum(rows.c.duration), 0),
+                  sa.func.coalesce(sa.func.sum(rows.c.ads_seen), 0),
+                  sa.func.coalesce(sa.func.sum(rows.c.paywall_hits), 0),
+                  sa.func.coalesce(sa.func.sum(rows.c.conversions), 0)) \
+          .group_by(rows.c.team_id, rows.c.user_id)
+
+    compacted = [dict(team_id=team_id, day=day, user_id=user_id, pageviews=n, duration=duration,
+                      ads_seen=ads_seen, paywall_hits=paywall_hits, conversions=conversions)
+                    for team_id, user_id, n, duration, ads_seen, paywall_hits, conversions in db.execute(q)]
+
+    for table in [pd, pv]:
+        db.execute(sa.delete(table)
+                     .where(table.day == day)
+                     .where(table.team_id.in_(team_ids))
+                     .execution_options(synchronize_session=False))
+    db.execute(sa.insert(pd), compacted)
+
+    return n_pvs
+
+def compact_before(db, game_id, day):
+    '''
+    Compacts every day of a game before day that still has pageviews.
+    Returns the number of pageviews compacted; the caller commits
+    '''
+
+    days = db.execute(sa.select(sa.distinct(m.Pageview.day))
+                        .where(m.Pageview.day < day)
+                        .where(m.Pageview.team_id.in_(sa.select(m.Team.id).where(m.Team.game_id == game_id)))
+                     ).scalars()
+
+    return sum(compact_day(db, game_id, d) for d in sorted(days))
+
+def compact_game(game_id, through=None):
+    '''
+    Compacts the pageviews of a game that are outside the trailing window
+    of its last simulated day (or of day through)
+    '''
+
+    with m.Session() as db:
+        if through is None:
+            through = db.execute(sa.select(sa.func.max(m.Pageview.day))
+                                   .where(m.Pageview.team_id.in_(sa.select(m.Team.id)
+                                                                   .where(m.Team.game_id == game_id)))
+                                ).scalar()
+        if through is None:
+            return 0
+
+        n_pvs = compact_before(db, game_id, through - TRAILING_DAYS + 1)
+        db.commit()
+
+    return n_pvs
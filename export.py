@@ -0,0 +1,179 @@
+'''
+This file exports a game to columnar Parquet files, so that teams can analyse
+their data in notebooks without joining the pageview table in SQL.
+
+A game is exported to <out_dir>/game_id=<id>/ as
+  - users.parquet     : one row per user, with their demographics
+  - articles.parquet  : one row per article, with its topic and author
+  - pageviews/        : one row per pageview, joined to the user, article,
+                        author and topic, partitioned by team and day
+                        (pageviews/team_id=<t>/day=<d>/*.parquet)
+  - pageview_days/    : one row per team, user and day for days whose
+                        pageviews were compacted (see compaction.py),
+                        joined to the user and partitioned in the same way
+
+Low-cardinality strings (topic name, age band, income band, author name) are
+stored as dictionary-encoded categoricals, with the same dictionary in every
+file. Pageviews are streamed from the database with models.stream_sql, so the
+export runs in bounded memory.
+
+load_team then reads a team's pageviews (or, with compacted=True, its compacted
+days) back as a pyarrow Table, using memory mapping - only the team's partition
+is read, and no SQL join is needed.
+'''
+
+import os
+import shutil
+
+import sqlalchemy as sa
+
+import models as m
+
+def _categorical(df, col, categories):
+    import pandas as pd
+
+    df[col] = pd.Categorical(df[col].astype(object), categories=categories)
+
+def _categories(db, column, *where):
+    q = sa.select(sa.distinct(column)).where(*where)
+    return sorted(v for v in db.execute(q).scalars() if v is not None)
+
+def _write_table(df, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+
+def _write_dataset(q, path, cats, dtypes, chunksize):
+    '''
+    Streams the results of a query to a dataset partitioned by team and day
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for i, chunk in enumerate(m.stream_sql(q, chunksize=chunksize, dtypes=dtypes)):
+        if not len(chunk):
+            break
+
+        for col in cats:
+            if col in chunk:
+                _categorical(chunk, col, cats[col])
+
+        pq.write_to_dataset(pa.Table.from_pandas(chunk, preserve_index=False),
+                            root_path        = path,
+                            partition_cols   = ['team_id', 'day'],
+                            basename_template= f'part-{i}-{{i}}.parquet')
+
+def game_dir(out_dir, game_id):
+    return os.path.join(out_dir, f'game_id={game_id}')
+
+def export_game(game_id, out_dir='export', chunksize=200000):
+    '''
+    Exports a game to out_dir (see the top of this file for the layout),
+    replacing any previous export of the same game
+    '''
+    root = game_dir(out_dir, game_id)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    with m.Session() as db:
+        cats = {'age'              : _categories(db, m.User.age, m.User.game_id == game_id),
+                'household_income' : _categories(db, m.User.household_income, m.User.game_id == game_id),
+                'topic'            : _categories(db, m.Topic.name, m.Topic.game_id == game_id),
+                'author_name'      : _categories(db, m.Author.name, m.Author.game_id == game_id)}
+
+    # Dimension tables
+    # ----------------
+    user_q = sa.select(m.User.id.label('user_id'), m.User.age, m.User.household_income,
+                       m.User.freq, m.User.first_day, m.User.ad_sensitivity, m.User.ad_blocked) \
+               .where(m.User.game_id == game_id)
+
+    article_q = sa.select(m.Article.id.label('article_id'), m.Article.day, m.Topic.name.label('topic'),
+                          m.Article.author_id, m.Author.name.label('author_name'),
+                          m.Author.quality.label('author_quality'), m.Article.wordcount, m.Article.vocab) \
+                  .join(m.Topic, m.Topic.id == m.Article.topic_id) \
+                  .join(m.Author, m.Author.id == m.Article.author_id) \
+                  .where(m.Article.game_id == game_id)
+
+    for name, q in [('users', user_q), ('articles', article_q)]:
+        df = m.run_sql(q)
+        for col in cats:
+            if col in df:
+                _categorical(df, col, cats[col])
+        _write_table(df, os.path.join(root, f'{name}.parquet'))
+
+    # Pageviews
+    # ---------
+    pv_q = sa.select(m.Pageview.team_id, m.Pageview.day, m.Pageview.user_id, m.Pageview.article_id,
+                     m.Pageview.duration, m.Pageview.ads_seen, m.Pageview.saw_paywall, m.Pageview.converted,
+                     m.User.age, m.User.household_income,
+                     m.Topic.name.label('topic'), m.Article.author_id,
+                     m.Author.name.label('author_name'), m.Author.quality.label('author_quality'),
+                     m.Article.wordcount) \
+             .join(m.User, m.User.id == m.Pageview.user_id) \
+             .join(m.Article, m.Article.id == m.Pageview.article_id) \
+             .join(m.Topic, m.Topic.id == m.Article.topic_id) \
+             .join(m.Author, m.Author.id == m.Article.author_id) \
+             .where(m.Pageview.team_id.in_(sa.select(m.Team.id).where(m.Team.game_id == game_id))) \
+             .order_by(m.Pageview.team_id, m.Pageview.day)
+
+    dtypes = {'team_id'     : 'int32',
+              'day'         : 'int32',
+              'user_id'     : 'int64',
+              'article_id'  : 'int64',
+              'duration'    : 'float32',
+              'ads_seen'    : 'int16',
+              'saw_paywall' : 'bool',
+              'converted'   : 'bool'}
+
+    _write_dataset(pv_q, os.path.join(root, 'pageviews'), cats, dtypes, chunksize)
+
+    # Compacted days
+    # --------------
+    pd_q = sa.select(m.PageviewDay.team_id, m.PageviewDay.day, m.PageviewDay.user_id, m.PageviewDay.pageviews,
+                     m.PageviewDay.duration,
+                     m.PageviewDay.ads_seen, m.PageviewDay.paywall_hits, m.PageviewDay.conversions,
+                     m.User.age, m.User.household_income) \
+             .join(m.User, m.User.id == m.PageviewDay.user_id) \
+             .where(m.PageviewDay.team_id.in_(sa.select(m.Team.id).where(m.Team.game_id == game_id))) \
+             .order_by(m.PageviewDay.team_id, m.PageviewDay.day)
+
+    dtypes = {'team_id'      : 'int32',
+              'day'          : 'int32',
+              'user_id'      : 'int64',
+              'pageviews'    : 'int16',
+              'duration'     : 'float32',
+              'ads_seen'     : 'int16',
+              'paywall_hits' : 'int16',
+              'conversions'  : 'int16'}
+
+    _write_dataset(pd_q, os.path.join(root, 'pageview_days'), cats, dtypes, chunksize)
+
+    return root
+
+def load_team(out_dir, game_id, team_id, columns=None, compacted=False):
+    '''
+    Reads the exported pageviews of a team (or, if compacted is True, its
+    compacted days) as a pyarrow Table, memory mapping the files, or None
+    if there are none. Call .to_pandas() on the result for a DataFrame
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    path = os.path.join(game_dir(out_dir, game_id), 'pageview_days' if compacted else 'pageviews',
+                        f'team_id={team_id}')
+    if not os.path.exists(path):
+        return None
+
+    return pq.read_table(path, columns=columns, memory_map=True,
+                         partitioning=ds.partitioning(pa.schema([('day', pa.int32())]), flavor='hive'))
+
+def load_table(out_dir, game_id, name):
+    '''
+    Reads an exported dimension table (users or articles) as a pyarrow Table
+    '''
+    import pyarrow.parquet as pq
+
+    return pq.read_table(os.path.join(game_dir(out_dir, game_id), f'{name}.parquet'), memory_map=True)
@@ -2,29 +2,221 @@ import rand_utils
 
 import sqlalchemy as sa
 import sqlalchemy.orm as sa_orm
-
-import pandas as pd
-import numpy as np
+from sqlalchemy.orm.collections import attribute_mapped_collection
 
 ################
 
+import contextlib
+import contextvars
 import itertools
 
 from metrics import log_metric
 
-engine          = sa.create_engine('sqlite:///game.db')
-Session         = sa_orm.sessionmaker(engine)
+DATABASE_URL    = 'sqlite:///game.db'
+
+# The engine is only created the first time it is needed (see get_engine),
+# so that importing this module doesn't touch the database
+engine          = None
+
+# Engine the current thread or task is routed to, if any (see use_engine)
+_routed_engine  = contextvars.ContextVar('routed_engine', default=None)
 
 mapper_registry = sa_orm.registry()
 Base            = mapper_registry.generate_base()
 
-def run_sql(s):
-    with engine.connect() as con:
-        return pd.DataFrame(con.execute(s).fetchall())
+def get_engine():
+    '''
+    Returns the engine the current thread or task is routed to (see
+    use_engine), or else the module's engine, creating it on first use
+    '''
+    global engine
+    
+    routed = _routed_engine.get()
+    if routed is not None:
+        return routed
+    
+    if engine is None:
+        engine = sa.create_engine(DATABASE_URL)
+    
+    return engine
+
+class LazySession(sa_orm.Session):
+    '''
+    A session bound to get_engine() unless it is given another bind, so
+    that the engine is created when the first session is opened rather
+    than at import time
+    '''
+    
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind if bind is not None else get_engine(), **kwargs)
+
+Session         = sa_orm.sessionmaker(class_=LazySession)
+
+def run_sql(s, params=None, dtypes=None):
+    '''
+    Runs a query (a SQL string or a SQLAlchemy statement) and returns all
+    of its results as a DataFrame, with column names and dtypes (see
+    stream_sql). For large results, prefer stream_sql or aggregate_sql
+    '''
+    import pandas as pd
+    
+    chunks = list(stream_sql(s, params=params, dtypes=dtypes))
+    
+    if len(chunks) == 1:
+        return chunks[0]
+    
+    return pd.concat(chunks, ignore_index=True)
+
+def _common_dtype(a, b):
+    '''
+    Returns the narrowest dtype that holds the values of both dtypes a and b
+    (nullable dtypes, as inferred by convert_dtypes; a might be None, for no
+    dtype yet): integers and booleans widen to integers, numbers to floats,
+    and anything else to object
+    '''
+    import pandas as pd
+    
+    if (a is None) or (a == b):
+        return b
+    
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+        if pd.api.types.is_float_dtype(a) or pd.api.types.is_float_dtype(b):
+            return pd.Float64Dtype()
+        return pd.Int64Dtype()
+    
+    return object
+
+def stream_sql(s, chunksize=50000, params=None, dtypes=None, arrow=False):
+    '''
+    Runs a query (a SQL string or a SQLAlchemy statement) and yields its
+    results in chunks of at most chunksize rows, so that only one chunk is
+    held in memory at a time
+      - Each chunk is a DataFrame with the query's column names, or a
+        pyarrow RecordBatch if arrow is True
+      - dtypes maps column names to dtypes. Columns that are not in dtypes
+        get pandas' nullable dtypes (so that NULLs don't turn integers into
+        floats), inferred from every chunk so far: when a chunk holds values
+        the previous ones didn't (eg: a float in a column of integers, see
+        _common_dtype), the column is widened from that chunk on, so later
+        chunks might have wider dtypes than earlier ones, but never fail
+    A query with no results yields a single empty chunk, so that callers
+    still see the column names
+    '''
+    import pandas as pd
+    
+    if isinstance(s, str):
+        s = sa.text(s)
+    
+    with get_engine().connect() as con:
+        result  = con.execution_options(stream_results=True).execute(s, params or {})
+        columns = list(result.keys())
+        # column -> dtype of the chunks so far (None while it only held NULLs)
+        types   = {}
+        first   = True
+        
+        while True:
+            rows = result.fetchmany(chunksize)
+            
+            if (not rows) and (not first):
+                break
+            first = False
+            
+            chunk    = pd.DataFrame.from_records(rows, columns=columns)
+            inferred = chunk.convert_dtypes().dtypes
+            
+            for col in columns:
+                if (dtypes is not None) and (col in dtypes):
+                    types[col] = dtypes[col]
+                elif not chunk[col].isna().all():
+                    types[col] = _common_dtype(types.get(col), inferred[col])
+            
+            chunk = chunk.astype({c: t for c, t in types.items() if t is not None})
+            
+            if arrow:
+                import pyarrow as pa
+                chunk = pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+            
+            yield chunk
+            
+            if not rows:
+                break
+
+def aggregate_sql(s, by, agg, chunksize=50000, params=None):
+    '''
+    Runs a query and aggregates its results as they stream in, so that
+    memory is bounded by the chunk size and the number of groups rather
+    than the number of rows
+      - by  : the column (or list of columns) to group by
+      - agg : a dictionary mapping columns to one of 'sum', 'count', 'min',
+              'max' or 'mean'
+    Returns a DataFrame indexed by the group columns, with one column per
+    entry in agg
+    '''
+    import pandas as pd
+    
+    # Every aggregation is computed from partial aggregations that can be
+    # combined across chunks; a mean is a sum divided by a count
+    partial_of = {'sum': 'sum', 'count': 'count', 'min': 'min', 'max': 'max'}
+    combine_of = {'sum': 'sum', 'count': 'sum',   'min': 'min', 'max': 'max'}
+    
+    partials = {}
+    for col, how in agg.items():
+        if how == 'mean':
+            partials[f'{col}__sum']   = (col, 'sum')
+            partials[f'{col}__count'] = (col, 'count')
+        else:
+            assert how in partial_of
+            partials[f'{col}__{how}'] = (col, how)
+    
+    running = None
+    for chunk in stream_sql(s, chunksize=chunksize, params=params):
+        part = chunk.groupby(by, dropna=False).agg(**{k: (c, partial_of[h]) for k, (c, h) in partials.items()})
+        
+        if running is None:
+            running = part
+        else:
+            running = pd.concat([running, part]) \
+                        .groupby(level=list(range(part.index.nlevels)), dropna=False) \
+                        .agg({k: combine_of[h] for k, (c, h) in partials.items()})
+    
+    out = pd.DataFrame(index=running.index)
+    for col, how in agg.items():
+        if how == 'mean':
+            out[col] = running[f'{col}__sum']/running[f'{col}__count']
+        else:
+            out[col] = running[f'{col}__{how}']
+    
+    return out
+
+def use_database(url):
+    '''
+    Points the module at a different database (eg: a scratch file for
+    benchmarks). Sessions opened from then on use the new engine, so
+    modules that imported Session keep working
+    '''
+    global engine
+    
+    engine = sa.create_engine(url)
+    
+    return engine
+
+@contextlib.contextmanager
+def use_engine(bind):
+    '''
+    Routes get_engine() - and so every Session opened without a bind,
+    run_sql and stream_sql - to another engine within the block, for the
+    current thread or asyncio task only (eg: a game's shard, see
+    shards.py); other threads keep using their own engine
+    '''
+    token = _routed_engine.set(bind)
+    try:
+        yield bind
+    finally:
+        _routed_engine.reset(token)
 
 def create_db():
-    mapper_registry.metadata.drop_all(engine)
-    mapper_registry.metadata.create_all(engine)
+    mapper_registry.metadata.drop_all(get_engine())
+    mapper_registry.metadata.create_all(get_engine())
 
 # not an ORM wrapper
 class BaseStrategy:
@@ -85,7 +277,9 @@ class Author(Base):
                                --> generated in simulate_static.add_author_productivities
       - topic_expertises : indicates the fact that a given author might have
                            an expertise in a specific topic. Each author and topic
-                           will have a row in AuthorTopic; see there for details
+                           will have a row in AuthorTopic, unless the game stores
+                           expertises sparsely; see there for details. This is a
+                           dictionary keyed by topic id
     '''
     
     __tablename__ = 'author'
@@ -98,20 +292,66 @@ class Author(Base):
     productivity      = sa.Column(sa.Integer)
     
     game              = sa_orm.relationship('Game', back_populates='authors')
-    topic_expertises  = sa_orm.relationship('AuthorTopic', back_populates='author')
+    topic_expertises  = sa_orm.relationship('AuthorTopic', back_populates='author',
+                                            collection_class=attribute_mapped_collection('topic_id'))
     
     def topic_expertise(self, topic):
         '''
         Returns the topic_expertise object for a specific topic
-        object
+        object, or None if it isn't stored (in games that store
+        expertises sparsely, the expertise is then 0)
         '''
         
-        out = [t_e for t_e in self.topic_expertises if t_e.topic == topic]
-        
-        assert len(out) == 1
-        
-        return out[0]
+        return self.topic_expertises.get(topic.id)
         
+class DailyRollup(Base):
+    '''
+    Daily key figures for one team in one game, materialized from the
+    pageview table so that dashboards don't need to scan it. Rows are
+    written by rollups.update_rollups as each day is simulated, and can be
+    recomputed from scratch with rollups.rebuild_rollups
+      - visitors     : the number of distinct users who saw a page
+      - pageviews    : the number of pageviews
+      - ads_served   : the total number of ads seen
+      - paywall_hits : the number of pageviews that hit the paywall
+      - conversions  : the number of users who subscribed that day
+      - revenue      : the estimated revenue from those subscriptions, i.e.,
+                       the sum of the cost of the strategy they subscribed to
+    '''
+    
+    __tablename__ = 'daily_rollup'
+    
+    game_id      = sa.Column(sa.ForeignKey('game.id'), primary_key=True)
+    team_id      = sa.Column(sa.ForeignKey('team.id'), primary_key=True)
+    day          = sa.Column(sa.Integer, primary_key=True)
+    
+    visitors     = sa.Column(sa.Integer, default=0)
+    pageviews    = sa.Column(sa.Integer, default=0)
+    ads_served   = sa.Column(sa.Integer, default=0)
+    paywall_hits = sa.Column(sa.Integer, default=0)
+    conversions  = sa.Column(sa.Integer, default=0)
+    revenue      = sa.Column(sa.Float, default=0)
+    
+class DailySegmentRollup(Base):
+    '''
+    The same figures as DailyRollup, broken down by user demographics
+    (age and household_income bands)
+    '''
+    
+    __tablename__ = 'daily_segment_rollup'
+    
+    game_id          = sa.Column(sa.ForeignKey('game.id'), primary_key=True)
+    team_id          = sa.Column(sa.ForeignKey('team.id'), primary_key=True)
+    day              = sa.Column(sa.Integer, primary_key=True)
+    age              = sa.Column(sa.String(10), primary_key=True)
+    household_income = sa.Column(sa.String(10), primary_key=True)
+    
+    visitors         = sa.Column(sa.Integer, default=0)
+    pageviews        = sa.Column(sa.Integer, default=0)
+    ads_served       = sa.Column(sa.Integer, default=0)
+    paywall_hits     = sa.Column(sa.Integer, default=0)
+    conversions      = sa.Column(sa.Integer, default=0)
+    revenue          = sa.Column(sa.Float, default=0)
 
 class Event(Base):
     '''
@@ -130,9 +370,14 @@ class Event(Base):
                            lead to an article on day 0 will be 0.8. Four days later, the
                            probability will be 0.8*0.8
                                 --> Generated in simulate_static.event_intensity
+      - end              : the last day on which the event can still lead to an
+                           article (i.e., the last day its time effect is above
+                           0.01)
+                                --> Generated in simulate_static.event_end
       - topic_relevances : indicates the fact a given event might lead to articles of
                            certain topics with different probabilities. Each event and
-                           topic will have a row in EventTopic; see there for details
+                           topic will have a row in EventTopic; see there for details.
+                           This is a dictionary keyed by topic id
     '''
 
     __tablename__ = 'event'
@@ -141,10 +386,12 @@ class Event(Base):
     game_id           = sa.Column(sa.ForeignKey('game.id'))
     
     start             = sa.Column(sa.Integer)
+    end               = sa.Column(sa.Integer)
     intensity         = sa.Column(sa.Integer)
     
     game              = sa_orm.relationship('Game', back_populates='events')
-    topic_relevances  = sa_orm.relationship('EventTopic',back_populates='event')
+    topic_relevances  = sa_orm.relationship('EventTopic', back_populates='event',
+                                            collection_class=attribute_mapped_collection('topic_id'))
         
 class Game(Base, rand_utils.Rand_utils_mixin):
     '''
@@ -167,6 +414,12 @@ class Game(Base, rand_utils.Rand_utils_mixin):
     n_authors    = sa.Column(sa.Integer, nullable=False)
     n_users      = sa.Column(sa.Integer, nullable=False)
     
+    # Sparse storage of author expertises and user affinities; when either
+    # is set, only the top sparse_top_k entries (and/or those above
+    # sparse_threshold) are stored, renormalized. See sparse.py
+    sparse_top_k     = sa.Column(sa.Integer, nullable=True)
+    sparse_threshold = sa.Column(sa.Float, nullable=True)
+    
     random_state = sa.Column(sa.String(20000), default='')
     
     teams        = sa_orm.relationship('Team', back_populates='game')
@@ -175,15 +428,51 @@ class Game(Base, rand_utils.Rand_utils_mixin):
     events       = sa_orm.relationship('Event', back_populates='game')
     articles     = sa_orm.relationship('Article', back_populates='game')
     users        = sa_orm.relationship('User', back_populates='game')
+    
+    @staticmethod
+    def load_options(users=False):
+        '''
+        Returns loader options that eagerly load the whole graph of a game
+        (topics, authors and their expertises, events and their relevances,
+        articles, teams and their strategies, and optionally users with
+        their interests and affinities), with one query per relationship
+        rather than one per object
+        '''
+        options = [sa_orm.selectinload(Game.topics),
+                   sa_orm.selectinload(Game.authors).selectinload(Author.topic_expertises),
+                   sa_orm.selectinload(Game.events).selectinload(Event.topic_relevances),
+                   sa_orm.selectinload(Game.articles),
+                   sa_orm.selectinload(Game.teams).selectinload(Team.strategies)]
+        
+        if users:
+            options += [sa_orm.selectinload(Game.users).selectinload(User.topic_interests),
+                        sa_orm.selectinload(Game.users).selectinload(User.author_affinities)]
+        
+        return options
+    
+    @staticmethod
+    def load(db, game_id, users=False):
+        '''
+        Loads a game and its whole graph (see load_options) in a fixed
+        number of queries. The game keeps these options: if it expires
+        (eg: when the session commits), accessing it reloads the whole
+        graph, so prefer db.get in code that commits as it goes
+        '''
+        q = sa.select(Game).where(Game.id == game_id).options(*Game.load_options(users))
+        return db.execute(q).scalar_one()
 
 class Pageview(Base):
     '''
     This class represents a pageview a specific user saw in a specific
-    game
+    game. Once a day leaves the trailing window the simulation reads, its
+    pageviews are compacted into PageviewDay rows (see compaction.py)
     '''
     
     __tablename__ = 'pageview'
     
+    # Rollups aggregate a single team and day at a time
+    __table_args__ = (sa.Index('ix_pageview_team_day', 'team_id', 'day'),)
+    
     id          = sa.Column(sa.Integer, primary_key=True)
     user_id     = sa.Column(sa.Integer, sa.ForeignKey('user.id'))
     article_id  = sa.Column(sa.Integer, sa.ForeignKey('article.id'))
@@ -199,6 +488,30 @@ class Pageview(Base):
     article     = sa_orm.relationship('Article')
     team        = sa_orm.relationship('Team')
 
+class PageviewDay(Base):
+    '''
+    The pageviews of a user on a team's site on one day, compacted into a
+    single row once the day has left the trailing window the simulation
+    reads (see compaction.py)
+      - pageviews    : the number of pageviews
+      - duration     : their total duration, in minutes
+      - ads_seen     : the total number of ads seen
+      - paywall_hits : the number of pageviews that hit the paywall
+      - conversions  : the number of those that led to a subscription
+    '''
+    
+    __tablename__ = 'pageview_day'
+    
+    team_id      = sa.Column(sa.Integer, sa.ForeignKey('team.id'), primary_key=True)
+    day          = sa.Column(sa.SmallInteger, primary_key=True)
+    user_id      = sa.Column(sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
+    
+    pageviews    = sa.Column(sa.SmallInteger, nullable=False)
+    duration     = sa.Column(sa.Float, nullable=False)
+    ads_seen     = sa.Column(sa.SmallInteger, nullable=False)
+    paywall_hits = sa.Column(sa.SmallInteger, nullable=False)
+    conversions  = sa.Column(sa.SmallInteger, nullable=False)
+
 class Player(Base):
     '''
     This class represents a single player, who might belong to one
@@ -217,8 +530,18 @@ class Player(Base):
 class Strategy(Base):
     '''
     This class describes a strategy
-    
-    TODO
+      - cost     : the price of a subscription
+      - ads      : the number of ads shown on each pageview
+      - free_pvs : the number of pageviews a user can read before hitting
+                   the paywall
+      - segment  : the pageviews the strategy applies to, as a dictionary
+                   mapping user or article attributes to the list of values
+                   covered, eg: {'age': ['15 to 24'], 'topic_id': [3, 4]};
+                   see strategy_rules.SEGMENT_ATTRIBUTES. None applies to
+                   every pageview
+      - priority : when several strategies of a team apply to a pageview,
+                   the one with the highest priority wins (then the most
+                   recent one)
     '''
 
     __tablename__ = 'strategy'
@@ -230,6 +553,9 @@ class Strategy(Base):
     ads            = sa.Column(sa.Integer)
     free_pvs       = sa.Column(sa.Integer)
     
+    segment        = sa.Column(sa.JSON, nullable=True)
+    priority       = sa.Column(sa.Integer, nullable=False, default=0)
+    
     team           = sa_orm.relationship('Team')
     users_assigned = sa_orm.relationship('UserStrategy', back_populates='strategy')
 
@@ -254,9 +580,33 @@ class Team(Base, rand_utils.Rand_utils_mixin):
     
     random_state = sa.Column(sa.String(20000), default='')
     
+    # Decayed pageview counts of each author on the team's site, keyed by
+    # author id; see popularity.py
+    author_popularity = sa.Column(sa.JSON, nullable=True)
+    
     game         = sa_orm.relationship('Game', back_populates='teams')
     strategies   = sa_orm.relationship('Strategy', back_populates='team')
     players      = sa_orm.relationship('Player', secondary='player_team', back_populates='teams')
+    
+    def get_strategy_for_user(self, user, article, day, strategies=None):
+        '''
+        Returns the strategy that applies to a specific user reading a
+        specific article on a specific day: of the strategies whose segment
+        matches, the one with the highest priority, then the most recent.
+        Teams are given an unsegmented strategy based on BaseStrategy when
+        they are created
+        
+        strategies are the team's strategies, if already loaded (eg: as
+        views.StrategyView); defaults to self.strategies. To find the
+        strategies of many pageviews at once, see strategy_rules
+        '''
+        import strategy_rules
+        
+        if strategies is None:
+            strategies = self.strategies
+        
+        return max((s for s in strategies if strategy_rules.segment_matches(s.segment, user, article)),
+                   key=strategy_rules.precedence)
 
 class Topic(Base):
     '''
@@ -276,6 +626,8 @@ class User(Base):
     '''
     This class represents a single user, associated with one specific
     game. Most data generated in simulate_static
+      - topic_interests   : dictionary of UserTopic, keyed by topic id
+      - author_affinities : dictionary of UserAuthor, keyed by author id
     '''
     
     __tablename__  = 'user'
@@ -298,8 +650,10 @@ class User(Base):
     internet_usage_index = sa.Column(sa.Integer)
 
     game              = sa_orm.relationship('Game', back_populates='users')
-    topic_interests   = sa_orm.relationship('UserTopic', back_populates='user')
-    author_affinities = sa_orm.relationship('UserAuthor', back_populates='user')
+    topic_interests   = sa_orm.relationship('UserTopic', back_populates='user',
+                                            collection_class=attribute_mapped_collection('topic_id'))
+    author_affinities = sa_orm.relationship('UserAuthor', back_populates='user',
+                                            collection_class=attribute_mapped_collection('author_id'))
     pageviews         = sa_orm.relationship('Pageview', back_populates='user', lazy='dynamic')
     strategies        = sa_orm.relationship('UserStrategy', back_populates='user')
 
@@ -311,7 +665,10 @@ class User(Base):
 class AuthorTopic(Base):
     '''
     Many-to-many connection between author and topic
-      - expertise : the author's expertise for that topic
+      - expertise : the author's expertise for that topic. For each
+                    author, expertises sum to 1 over the stored topics.
+                    If the game has sparse_top_k or sparse_threshold set,
+                    only the author's top topics have a row
     '''
     
     __tablename__ = 'author_topic'
@@ -356,6 +713,10 @@ class PlayerTeam(Base):
 class UserAuthor(Base):
     '''
     Many-to-many connection table between user and author
+      - affinity : how much the user likes that author. For each user,
+                   affinities sum to 1 over the stored authors. If the
+                   game has sparse_top_k or sparse_threshold set, only
+                   the user's top authors have a row
     '''
     
     __tablename__ = 'user_author'
@@ -377,6 +738,9 @@ class UserStrategy(Base):
     
     __tablename__ = 'user_strategy'
     
+    # Rollups look up the conversions of a single day
+    __table_args__ = (sa.Index('ix_user_strategy_start_day', 'start_day'),)
+    
     id          = sa.Column(sa.Integer, primary_key=True)
     user_id     = sa.Column(sa.ForeignKey('user.id'))
     strategy_id = sa.Column(sa.ForeignKey('strategy.id'))
@@ -0,0 +1,67 @@
+'''
+This file maintains the popularity of authors, as seen by each team: an
+exponentially decayed count of the team's pageviews of each author's articles,
+so that recent pageviews weigh more than old ones. The popularity of an author
+is their share of that decayed count (a number between 0 and 1 that sums to 1
+over authors, once any pageview has been seen).
+
+Popularity is updated incrementally: once a day's pageviews are final (see
+simulate_dynamic.PageviewBatch), every count is multiplied by DECAY and the
+day's pageviews are added - so it never needs an aggregate query over the
+pageview table. Between runs, it is stored on the team (Team.author_popularity),
+in the same way as the team's random_state.
+'''
+
+import numpy as np
+
+# Fraction of the count kept from one day to the next (a half-life of about
+# three days)
+DECAY = 0.8
+
+class Popularity:
+    '''
+    The decayed pageview counts of the authors of a game, for one team
+      - author_ids : the ids of the authors, sorted
+      - counts     : the decayed count of each author
+    '''
+
+    def __init__(self, author_ids, counts=None):
+        self.author_ids = np.asarray(author_ids, dtype=np.int64)
+        self.counts     = np.zeros(len(self.author_ids)) if counts is None else np.asarray(counts, dtype=float)
+        self.total      = self.counts.sum()
+        self._rows      = {a: i for i, a in enumerate(self.author_ids.tolist())}
+
+    @classmethod
+    def from_team(cls, team, author_ids):
+        '''
+        Loads the popularity stored on a team; authors that aren't stored
+        start at 0
+        '''
+        stored = team.author_popularity or {}
+        return cls(author_ids, [stored.get(str(a), 0.0) for a in np.asarray(author_ids).tolist()])
+
+    def save(self, team):
+        team.author_popularity = {str(a): c for a, c in zip(self.author_ids.tolist(), self.counts.tolist()) if c > 0}
+
+    def share(self, author_id):
+        '''
+        Returns the popularity of an author, i.e., their share of the team's
+        decayed pageviews
+        '''
+        if self.total <= 0:
+            return 0.0
+        return self.counts[self._rows[author_id]] / self.total
+
+    def shares(self):
+        return self.counts / self.total if self.total > 0 else np.zeros(len(self.counts))
+
+    def add_day(self, author_ids):
+        '''
+        Decays every count by a day, and adds a day's pageviews, given as the
+        author id of each pageview
+        '''
+        self.counts *= DECAY
+        if len(author_ids):
+            rows = np.searchsorted(self.author_ids, np.asarray(author_ids, dtype=np.int64))
+            self.counts += np.bincount(rows, minlength=len(self.counts))
+        self.total = self.counts.sum()
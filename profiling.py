@@ -0,0 +1,197 @@
+'''
+This module records where time goes while a game is generated or simulated.
+
+Code that wants to be measured wraps each of its phases in a with block
+
+    with profiling.phase('authors') as p:
+        ...
+        p.rows += 1
+
+and, for every phase name, the module accumulates
+  - calls      : how many times the phase was entered (per-day stages of the
+                 dynamic simulation are entered once per day)
+  - wall_s     : wall-clock time spent in the phase
+  - cpu_s      : CPU time spent in the phase
+  - rows       : rows produced, as reported by the phase itself
+  - rng_draws  : random variables drawn through rand_utils.generate_rv
+  - peak_mem   : the peak memory allocated by Python while in the phase,
+                 in bytes (measured with tracemalloc)
+
+Profiling is off by default; phase() then costs a single function call and
+nothing is recorded. Call enable() first, and write_report() at the end to
+save a machine-readable JSON report (this is what `cli.py --profile` does).
+'''
+
+import contextlib
+import datetime
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the report then omits max_rss_kb
+    resource = None
+
+phases       = {}
+enabled      = False
+trace_memory = False
+
+_stack       = []
+_started     = None
+
+class PhaseRecord:
+    '''
+    Accumulated measurements for one phase name. Phases add to rows
+    themselves; everything else is filled in by phase()
+    '''
+
+    def __init__(self, name):
+        self.name      = name
+        self.calls     = 0
+        self.wall_s    = 0.0
+        self.cpu_s     = 0.0
+        self.rows      = 0
+        self.rng_draws = 0
+        self.peak_mem  = 0
+
+        # Peak memory of nested phases, folded in when this phase ends
+        self._child_peak = 0
+
+    def as_dict(self):
+        return {'name'      : self.name,
+                'calls'     : self.calls,
+                'wall_s'    : self.wall_s,
+                'cpu_s'     : self.cpu_s,
+                'rows'      : self.rows,
+                'rng_draws' : self.rng_draws,
+                'peak_mem'  : self.peak_mem if trace_memory else None}
+
+class _NullRecord:
+    '''
+    Stands in for a PhaseRecord when profiling is disabled, so phases can
+    unconditionally do p.rows += n
+    '''
+    rows = 0
+
+    def __setattr__(self, k, v):
+        pass
+
+_null_record = _NullRecord()
+
+def _n_draws():
+    '''
+    Returns the number of RVs drawn so far through rand_utils.generate_rv.
+    rand_utils is not imported here, so profiling stays cheap to import;
+    if nothing has imported it yet, nothing has been drawn
+    '''
+    rand_utils = sys.modules.get('rand_utils')
+    return rand_utils.n_draws if rand_utils is not None else 0
+
+def enable(memory=True):
+    '''
+    Starts recording phases. If memory is True, tracemalloc is started to
+    measure peak memory per phase; this slows allocation-heavy code down
+    noticeably, so pass memory=False when only timings matter
+    '''
+
+    global enabled, trace_memory, _started
+
+    reset()
+
+    enabled      = True
+    trace_memory = memory
+    _started     = time.time()
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global enabled
+
+    enabled = False
+
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def reset():
+    phases.clear()
+    _stack.clear()
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Context manager measuring one run of the phase called name. It yields
+    the PhaseRecord for that name, so the caller can add to its rows
+    '''
+
+    if not enabled:
+        yield _null_record
+        return
+
+    if name not in phases:
+        phases[name] = PhaseRecord(name)
+    record = phases[name]
+
+    # tracemalloc only tracks a single peak, so fold the peak reached so
+    # far into the enclosing phase before resetting it for this one
+    if trace_memory:
+        if _stack:
+            _stack[-1]._child_peak = max(_stack[-1]._child_peak,
+                                         tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    _stack.append(record)
+    record._child_peak = 0
+
+    draws_0 = _n_draws()
+    wall_0  = time.perf_counter()
+    cpu_0   = time.process_time()
+
+    try:
+        yield record
+    finally:
+        record.calls     += 1
+        record.wall_s    += time.perf_counter() - wall_0
+        record.cpu_s     += time.process_time() - cpu_0
+        record.rng_draws += _n_draws() - draws_0
+
+        _stack.pop()
+
+        if trace_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], record._child_peak)
+            record.peak_mem = max(record.peak_mem, peak)
+
+            if _stack:
+                _stack[-1]._child_peak = max(_stack[-1]._child_peak, peak)
+
+def report(**info):
+    '''
+    Returns the profiling report as a dictionary; any keyword arguments
+    are included at the top level (eg: the command that was run)
+    '''
+
+    out = dict(info)
+    out['started']    = (datetime.datetime.fromtimestamp(_started).isoformat()
+                                    if _started is not None else None)
+    out['wall_s']     = time.time() - _started if _started is not None else None
+    out['max_rss_kb'] = None
+    out['python']     = sys.version.split()[0]
+    out['phases']     = [r.as_dict() for r in phases.values()]
+
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        out['max_rss_kb'] = max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+    return out
+
+def write_report(path, **info):
+    '''
+    Writes the report returned by report() to path as JSON
+    '''
+
+    with open(path, 'w') as f:
+        json.dump(report(**info), f, indent=2)
@@ -0,0 +1,271 @@
+'''
+This module reports the progress of long-running work (game_static,
+generate_pvs) as a stream of structured events, rather than with print and
+tqdm, so that progress can be shown on a console, logged, or passed on by a
+worker or service (see service.py).
+
+Code that reports progress wraps each of its phases in a task
+
+    with progress.task('articles', total=game.n_days) as t:
+        for day in range(game.n_days):
+            ...
+            t.update()
+
+or iterates through track(iterable, phase). Every task emits a 'start' event,
+'progress' events at most every INTERVAL seconds, and an 'end' event. Each
+event is a dictionary with
+  - event     : 'start', 'progress', 'end' or 'note'
+  - phase     : the name of the task
+  - done      : items done so far (total, if known, is the number expected)
+  - rate      : items per second since the task started
+  - eta_s     : estimated seconds left (None if total is unknown)
+  - elapsed_s : seconds since the task started
+  - rss_kb    : the resident memory of the process, in kilobytes
+note(phase, **fields) emits a one-off event with arbitrary fields (eg: the
+calibration figures printed at the end of generate_pvs).
+
+Events go to every registered sink: ConsoleSink, JsonLinesSink or
+CallbackSink (see add_sink, or the sink context manager). With no sinks, which
+is the default, task() returns a task whose update does nothing; otherwise,
+update reads the clock only every so many items (adapting the stride to the
+task's rate), so that reporting costs next to nothing in hot loops.
+'''
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; rss_kb is then None
+    resource = None
+
+# Seconds between progress events of a task
+INTERVAL = 0.5
+
+sinks    = []
+
+def _rss_kb():
+    '''
+    Returns the current resident memory of the process in kilobytes (on
+    Linux), or else its peak resident memory
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+def emit(event):
+    for s in sinks:
+        s(event)
+
+# -----------------------
+# -  Section 1; tasks   -
+# -----------------------
+
+class Task:
+    '''
+    A phase whose progress is reported; see the top of this file
+    '''
+
+    def __init__(self, phase, total=None):
+        self.phase    = phase
+        self.total    = total
+        self.done     = 0
+
+        self._started = time.perf_counter()
+        self._last    = self._started
+        # Items between two reads of the clock, and the count at which the
+        # clock is next read
+        self._stride  = 1
+        self._check   = 1
+
+    def event(self, kind, **fields):
+        now     = time.perf_counter()
+        elapsed = now - self._started
+        rate    = self.done / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if (self.total is not None) and (rate > 0):
+            eta = max(0.0, (self.total - self.done) / rate)
+
+        return dict({'event'     : kind,
+                     'phase'     : self.phase,
+                     'done'      : self.done,
+                     'total'     : self.total,
+                     'rate'      : rate,
+                     'eta_s'     : eta,
+                     'elapsed_s' : elapsed,
+                     'rss_kb'    : _rss_kb(),
+                     'time'      : time.time()}, **fields)
+
+    def update(self, n=1):
+        self.done += n
+        if self.done >= self._check:
+            self._tick()
+
+    def _tick(self):
+        now = time.perf_counter()
+        if now - self._last >= INTERVAL:
+            self._last = now
+            emit(self.event('progress'))
+
+        # Aim for about ten reads of the clock per interval, growing the
+        # stride gradually in case the first items were unusually fast
+        elapsed = now - self._started
+        if elapsed > 0:
+            self._stride = max(1, min(self._stride * 2, int(self.done / elapsed * INTERVAL / 10)))
+        self._check = self.done + self._stride
+
+    def start(self):
+        emit(self.event('start'))
+        return self
+
+    def end(self, **fields):
+        emit(self.event('end', **fields))
+
+class _NullTask:
+    '''
+    Stands in for a Task when there are no sinks
+    '''
+
+    done = 0
+
+    def update(self, n=1):
+        pass
+
+    def end(self, **fields):
+        pass
+
+_null_task = _NullTask()
+
+@contextlib.contextmanager
+def task(phase, total=None):
+    '''
+    Reports the progress of a phase within the block; see the top of this
+    file
+    '''
+    if not sinks:
+        yield _null_task
+        return
+
+    t = Task(phase, total).start()
+    try:
+        yield t
+    finally:
+        t.end()
+
+def track(iterable, phase, total=None):
+    '''
+    Yields the items of iterable, reporting them as the progress of a phase
+    '''
+    if total is None and hasattr(iterable, '__len__'):
+        total = len(iterable)
+
+    with task(phase, total) as t:
+        for item in iterable:
+            yield item
+            t.update()
+
+def note(phase, **fields):
+    '''
+    Emits a one-off event with arbitrary fields
+    '''
+    if sinks:
+        emit(dict({'event': 'note', 'phase': phase, 'time': time.time()}, **fields))
+
+# -----------------------
+# -  Section 2; sinks   -
+# -----------------------
+
+class ConsoleSink:
+    '''
+    Renders events as one line per phase on a console (stderr by default),
+    redrawn in place when the console is a terminal
+    '''
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.tty    = self.stream.isatty()
+
+    def __call__(self, event):
+        if event['event'] == 'note':
+            fields = ', '.join(f'{k}={v}' for k, v in event.items() if k not in ('event', 'phase', 'time'))
+            self.stream.write(f'{event["phase"]}: {fields}\n')
+            return
+
+        if event['event'] == 'progress' and not self.tty:
+            return
+
+        done  = f'{event["done"]}' + (f'/{event["total"]}' if event['total'] is not None else '')
+        line  = f'{event["phase"]:<16}{done:>14}  {event["rate"]:>10.1f} it/s'
+        if event['event'] == 'end':
+            line += f'  {event["elapsed_s"]:>7.1f}s'
+        elif event['eta_s'] is not None:
+            line += f'  eta {event["eta_s"]:>5.1f}s'
+        if event['rss_kb'] is not None:
+            line += f'  {event["rss_kb"] / 1024:>7.1f} MB'
+
+        if self.tty:
+            self.stream.write('\r' + line + ('\n' if event['event'] == 'end' else ''))
+        elif event['event'] == 'end':
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+class JsonLinesSink:
+    '''
+    Appends every event to a file, as one JSON object per line
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CallbackSink:
+    '''
+    Passes every event to a function, eg: to forward it from a worker
+    '''
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, event):
+        self.f(event)
+
+def add_sink(s):
+    sinks.append(s)
+    return s
+
+def remove_sink(s):
+    if s in sinks:
+        sinks.remove(s)
+    if hasattr(s, 'close'):
+        s.close()
+
+@contextlib.contextmanager
+def sink(s):
+    '''
+    Registers a sink within the block
+    '''
+    add_sink(s)
+    try:
+        yield s
+    finally:
+        remove_sink(s)
@@ -30,10 +30,27 @@ parallel without upsetting each other
 '''
 
 import numpy as np
-from faker import Faker
 import json
 
-fake = Faker()
+# The faker engine is created on first use (see get_fake); instantiating
+# Faker loads all of its providers, which is slow
+fake = None
+
+def get_fake():
+    '''
+    Returns the faker engine, creating it on first use
+    '''
+    global fake
+    
+    if fake is None:
+        from faker import Faker
+        fake = Faker()
+    
+    return fake
+
+# Running count of random variables generated through generate_rv; used
+# by the profiling module to attribute RNG draws to phases
+n_draws = 0
 
 def init_random_state(obj):
     '''
@@ -43,7 +60,7 @@ def init_random_state(obj):
     '''
     
     np.random.seed(obj.seed)
-    fake.random.seed(obj.seed)
+    get_fake().random.seed(obj.seed)
     
     obj.random_state = get_random_state()
 
@@ -65,7 +82,7 @@ def get_random_state():
     
     # random random state
     # -------------------
-    random_state = fake.random.getstate()
+    random_state = get_fake().random.getstate()
     
     # Concatenate, serialize, and return
     # ----------------------------------
@@ -88,7 +105,7 @@ def set_random_state(state):
     # -------------------
     # First, convert element 1 to a tuple to avoid an error
     random_state[1] = tuple(random_state[1])
-    fake.random.setstate(random_state)
+    get_fake().random.setstate(random_state)
 
 def generate_rv(obj, kind, n=1, **kwargs):
     '''
@@ -109,6 +126,8 @@ def generate_rv(obj, kind, n=1, **kwargs):
         and if n>1, this will be a list/array
     '''
     
+    global n_draws
+    
     # Check whether the random_state has been saved
     if ( (not hasattr(obj, 'random_state'))
                 or (obj.random_state is None)
@@ -124,6 +143,8 @@ def generate_rv(obj, kind, n=1, **kwargs):
         else:
             return [i/sum_x for i in x]
     
+    fake = get_fake()
+    
     # Dictionary mapping each variable type to a function
     # which generates that RV
     rv_kinds = {'uniform'     : lambda low=0, high=1  : np.random.uniform(size=n, low=low, high=high),
@@ -152,6 +173,7 @@ def generate_rv(obj, kind, n=1, **kwargs):
     
     # Update the random state
     obj.random_state = get_random_state()
+    n_draws         += n
     
     # Return
     return out
@@ -0,0 +1,204 @@
+'''
+This file maintains the daily rollup tables (DailyRollup and DailySegmentRollup
+in models), which hold every key figure a team looks at - pageviews, ads
+served, paywall hits, conversions and estimated revenue - per game, team and
+day, and broken down by user demographics.
+
+The rollups are maintained incrementally: generate_pvs calls update_rollups
+once a day's pageviews have been flushed, and update_rollups only aggregates
+the pageviews of that day (using the pageview (team_id, day) index, or the
+compacted PageviewDay rows of days outside the simulation's window). Dashboard
+and leaderboard queries then read the rollups, so their cost depends on the
+number of teams and days, not on the number of pageviews.
+
+rebuild_rollups recomputes every rollup of a game from scratch, eg: after
+pageviews were changed outside of the simulation.
+'''
+
+import sqlalchemy as sa
+
+import models as m
+
+METRICS = ['visitors', 'pageviews', 'ads_served', 'paywall_hits', 'conversions', 'revenue']
+
+def _day_figures(db, game_id, day, segment_cols):
+    '''
+    Aggregates the pageviews and conversions of a single day, grouped by
+    team and by segment_cols (User columns). Returns a dictionary mapping
+    (team_id, *segment values) to a dictionary of METRICS
+    '''
+
+    team_ids = sa.select(m.Team.id).where(m.Team.game_id == game_id)
+
+    # Pageview figures
+    # ----------------
+    # Pageviews of days that were compacted (see compaction.py) are read
+    # from PageviewDay instead
+    pv, pd = m.Pageview, m.PageviewDay
+    rows = sa.union_all(
+        sa.select(pv.team_id, pv.user_id,
+                  sa.literal(1).label('pageviews'),
+                  pv.ads_seen,
+                  sa.cast(pv.saw_paywall, sa.Integer).label('paywall_hits'))
+          .where(pv.day == day)
+          .where(pv.team_id.in_(team_ids)),
+        sa.select(pd.team_id, pd.user_id, pd.pageviews, pd.ads_seen, pd.paywall_hits)
+          .where(pd.day == day)
+          .where(pd.team_id.in_(team_ids))).subquery()
+
+    q = sa.select(rows.c.team_id,
+                  *segment_cols,
+                  sa.func.count(sa.distinct(rows.c.user_id)),
+                  sa.func.sum(rows.c.pageviews),
+                  sa.func.coalesce(sa.func.sum(rows.c.ads_seen), 0),
+                  sa.func.coalesce(sa.func.sum(rows.c.paywall_hits), 0)) \
+          .select_from(rows) \
+          .group_by(rows.c.team_id, *segment_cols)
+
+    if segment_cols:
+        q = q.join(m.User, m.User.id == rows.c.user_id)
+
+    out = {}
+    for row in db.execute(q):
+        key = tuple(row[:1 + len(segment_cols)])
+        visitors, pageviews, ads_served, paywall_hits = row[1 + len(segment_cols):]
+        out[key] = {'visitors'     : visitors,
+                    'pageviews'    : pageviews,
+                    'ads_served'   : ads_served,
+                    'paywall_hits' : paywall_hits,
+                    'conversions'  : 0,
+                    'revenue'      : 0.0}
+
+    # Conversions, and the revenue they bring
+    # ---------------------------------------
+    q = sa.select(m.Strategy.team_id,
+                  *segment_cols,
+                  sa.func.count(),
+                  sa.func.coalesce(sa.func.sum(m.Strategy.cost), 0)) \
+          .select_from(m.UserStrategy) \
+          .join(m.Strategy, m.Strategy.id == m.UserStrategy.strategy_id) \
+          .where(m.UserStrategy.start_day == day) \
+          .where(m.Strategy.team_id.in_(team_ids)) \
+          .group_by(m.Strategy.team_id, *segment_cols)
+
+    if segment_cols:
+        q = q.join(m.User, m.User.id == m.UserStrategy.user_id)
+
+    for row in db.execute(q):
+        key = tuple(row[:1 + len(segment_cols)])
+        conversions, revenue = row[1 + len(segment_cols):]
+        figures = out.setdefault(key, {k: 0 for k in METRICS})
+        figures['conversions'] = conversions
+        figures['revenue']     = float(revenue)
+
+    return out
+
+def update_rollups(db, game_id, day):
+    '''
+    Recomputes the rollups of a game for a single day, from that day's
+    pageviews and conversions. Must be called after the day's pageviews
+    have been flushed; the caller commits
+    '''
+
+    # Drop any rollups already computed for that day
+    for table in [m.DailyRollup, m.DailySegmentRollup]:
+        db.execute(sa.delete(table)
+                     .where(table.game_id == game_id)
+                     .where(table.day == day))
+
+    rows = [dict(game_id=game_id, team_id=team_id, day=day, **figures)
+                for (team_id,), figures in _day_figures(db, game_id, day, []).items()]
+    if rows:
+        db.execute(sa.insert(m.DailyRollup), rows)
+
+    segment_cols = [m.User.age, m.User.household_income]
+    rows = [dict(game_id=game_id, team_id=team_id, day=day, age=age,
+                 household_income=income, **figures)
+                for (team_id, age, income), figures in _day_figures(db, game_id, day, segment_cols).items()]
+    if rows:
+        db.execute(sa.insert(m.DailySegmentRollup), rows)
+
+def rebuild_rollups(game_id):
+    '''
+    Recomputes every rollup of a game from scratch
+    '''
+
+    with m.Session() as db:
+        team_ids = sa.select(m.Team.id).where(m.Team.game_id == game_id)
+
+        pv_days = sa.union(sa.select(m.Pageview.day).where(m.Pageview.team_id.in_(team_ids)),
+                           sa.select(m.PageviewDay.day).where(m.PageviewDay.team_id.in_(team_ids)))
+        conversion_days = sa.select(sa.distinct(m.UserStrategy.start_day)) \
+                            .select_from(m.UserStrategy) \
+                            .join(m.Strategy, m.Strategy.id == m.UserStrategy.strategy_id) \
+                            .where(m.Strategy.team_id.in_(team_ids))
+
+        days = set(db.execute(pv_days).scalars()) | set(db.execute(conversion_days).scalars())
+
+        for table in [m.DailyRollup, m.DailySegmentRollup]:
+            db.execute(sa.delete(table).where(table.game_id == game_id))
+
+        for day in sorted(d for d in days if d is not None):
+            update_rollups(db, game_id, day)
+
+        db.commit()
+
+# -------------------------------
+# -  Dashboard and leaderboard  -
+# -------------------------------
+
+def dashboard(team_id, start=None, end=None):
+    '''
+    Returns a DataFrame with one row per day, and a column for each of
+    METRICS, for a specific team (optionally between days start and end,
+    inclusive)
+    '''
+
+    q = sa.select(m.DailyRollup.day, *[getattr(m.DailyRollup, k) for k in METRICS]) \
+          .where(m.DailyRollup.team_id == team_id) \
+          .order_by(m.DailyRollup.day)
+
+    if start is not None:
+        q = q.where(m.DailyRollup.day >= start)
+    if end is not None:
+        q = q.where(m.DailyRollup.day <= end)
+
+    return m.run_sql(q)
+
+def segments(team_id, start=None, end=None):
+    '''
+    Returns a DataFrame with the total of each of METRICS per age and
+    household_income band for a specific team, over all days (or between
+    days start and end, inclusive). Note that visitors are summed over
+    days, so a user visiting on two days counts twice
+    '''
+
+    t = m.DailySegmentRollup
+    q = sa.select(t.age, t.household_income, *[sa.func.sum(getattr(t, k)).label(k) for k in METRICS]) \
+          .where(t.team_id == team_id) \
+          .group_by(t.age, t.household_income) \
+          .order_by(t.age, t.household_income)
+
+    if start is not None:
+        q = q.where(t.day >= start)
+    if end is not None:
+        q = q.where(t.day <= end)
+
+    return m.run_sql(q)
+
+def leaderboard(game_id):
+    '''
+    Returns a DataFrame ranking the teams of a game by total revenue, with
+    the total of each of METRICS
+    '''
+
+    t = m.DailyRollup
+    q = sa.select(m.Team.id.label('team_id'), m.Team.name,
+                  *[sa.func.coalesce(sa.func.sum(getattr(t, k)), 0).label(k) for k in METRICS]) \
+          .select_from(m.Team) \
+          .outerjoin(t, t.team_id == m.Team.id) \
+          .where(m.Team.game_id == game_id) \
+          .group_by(m.Team.id, m.Team.name) \
+          .order_by(sa.desc('revenue'))
+
+    return m.run_sql(q)
@@ -0,0 +1,221 @@
+'''
+This file is a scaling harness, meant to answer capacity planning questions
+such as "how big a game fits in 4 GB?" or "how does generation time grow with
+n_users?"
+
+Starting from a base game size, it sweeps each of n_users, n_authors and n_days
+in turn on a log grid (keeping the other two at their base value). At every
+point it generates a game with game_static, adds teams, and simulates a fixed
+number of dynamic days. Every point runs in a fresh process against its own
+scratch database, so it records
+  - static_s  : wall time of game_static
+  - dynamic_s : wall time of the simulated days
+  - rss_mb    : the peak resident memory of the process
+  - db_mb     : the size of the resulting database file
+
+It then fits the empirical growth exponent of each measure for each parameter
+(the slope of a log-log regression, so 1 means linear growth), writes the
+table to a CSV file, and prints it along with the exponents.
+
+Usage
+    python scaling.py
+    python scaling.py --users 1000,10000,100000 --dynamic-days 3 --output scaling.csv
+    python scaling.py --memory-budget 4096
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Base game size, and the sweep used for each parameter when none is given
+BASE   = {'n_users': 1000, 'n_authors': 20, 'n_days': 30}
+GRIDS  = {'n_users'   : (100, 10000),
+          'n_authors' : (5, 100),
+          'n_days'    : (10, 120)}
+
+MEASURES = ['static_s', 'dynamic_s', 'rss_mb', 'db_mb']
+
+def log_grid(low, high, n_points):
+    '''
+    Returns n_points integers spaced evenly on a log scale between low and
+    high (inclusive), without duplicates
+    '''
+    return sorted(set(int(round(x)) for x in np.logspace(np.log10(low), np.log10(high), n_points)))
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss/1024**2 if sys.platform == 'darwin' else max_rss/1024
+
+def run_point(n_users, n_authors, n_days, dynamic_days, n_teams, seed):
+    '''
+    Generates and simulates one game, and returns its measurements. This
+    is meant to run in a fresh process, so the peak RSS is its own
+    '''
+
+    # Imported here so the parent process stays small
+    import models as m
+    import simulate_static as ss
+    import simulate_dynamic as sd
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'game.db')
+        m.use_database(f'sqlite:///{path}')
+        m.create_db()
+
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            t_0 = time.perf_counter()
+            game_id = ss.game_static('Scaling', seed, n_days, n_days, n_authors, n_users)
+            static_s = time.perf_counter() - t_0
+
+            for i in range(n_teams):
+                sd.create_team(game_id, f'Team {i}', seed + i + 1)
+
+            t_0 = time.perf_counter()
+            sd.generate_pvs(game_id, 0, min(dynamic_days, n_days))
+            dynamic_s = time.perf_counter() - t_0
+
+        m.engine.dispose()
+
+        return {'n_users'   : n_users,
+                'n_authors' : n_authors,
+                'n_days'    : n_days,
+                'static_s'  : static_s,
+                'dynamic_s' : dynamic_s,
+                'rss_mb'    : peak_rss_mb(),
+                'db_mb'     : os.path.getsize(path)/1024**2}
+
+def run_isolated(**kwargs):
+    '''
+    Runs run_point in a brand new process
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(run_point, **kwargs).result()
+
+def fit_exponent(x, y):
+    '''
+    Returns the slope of log(y) against log(x), i.e., the k in y ~ x^k,
+    or None if there are not enough usable points
+    '''
+    pts = [(a, b) for a, b in zip(x, y) if a and b and b > 0]
+    if len(pts) < 2:
+        return None
+
+    x, y = zip(*pts)
+    return float(np.polyfit(np.log(x), np.log(y), 1)[0])
+
+def max_size_for_budget(x, y, budget):
+    '''
+    Fits y = a + b*x (memory has a fixed cost - the interpreter and the
+    libraries - plus a part that grows with the game) and returns the value
+    of x at which y reaches budget, or None if y does not grow with x
+    '''
+    pts = [(a, b) for a, b in zip(x, y) if a and b]
+    if len(pts) < 2:
+        return None
+
+    x, y = zip(*pts)
+    b, a = np.polyfit(x, y, 1)
+    if b <= 0:
+        return None
+
+    return int((budget - a)/b)
+
+def sweep(grids, dynamic_days, n_teams, seed):
+    '''
+    Runs every point of every sweep. Returns a dictionary mapping each
+    swept parameter to its list of results
+    '''
+    out = {}
+    for param, values in grids.items():
+        out[param] = []
+        for v in values:
+            point = dict(BASE, **{param: v})
+            print(f'Running {param}={v} ...', flush=True)
+            out[param].append(run_isolated(dynamic_days=dynamic_days, n_teams=n_teams,
+                                           seed=seed, **point))
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and memory scaling harness')
+    parser.add_argument('--users', help='Comma-separated n_users values to sweep')
+    parser.add_argument('--authors', help='Comma-separated n_authors values to sweep')
+    parser.add_argument('--days', help='Comma-separated n_days values to sweep')
+    parser.add_argument('--points', type=int, default=4, help='Points per default log grid')
+    parser.add_argument('--only', help='Comma-separated parameters to sweep (eg: n_users)')
+    parser.add_argument('--dynamic-days', type=int, default=3, help='Dynamic days simulated per point')
+    parser.add_argument('--teams', type=int, default=2, help='Teams per game')
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--memory-budget', type=float, default=4096,
+                        help='Memory budget in MB used to extrapolate the largest game')
+    parser.add_argument('--output', default='scaling.csv', help='CSV file to write the table to')
+    args = parser.parse_args()
+
+    explicit = {'n_users': args.users, 'n_authors': args.authors, 'n_days': args.days}
+    grids    = {}
+    for param, (low, high) in GRIDS.items():
+        if args.only and param not in args.only.split(','):
+            continue
+        if explicit[param]:
+            grids[param] = [int(v) for v in explicit[param].split(',')]
+        else:
+            grids[param] = log_grid(low, high, args.points)
+
+    results = sweep(grids, args.dynamic_days, args.teams, args.seed)
+
+    # Write the table
+    # ---------------
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['swept'] + list(BASE) + MEASURES)
+        writer.writeheader()
+        for param, rows in results.items():
+            for row in rows:
+                writer.writerow(dict(row, swept=param))
+
+    print()
+    print(f'{"swept":<10}{"n_users":>10}{"n_authors":>10}{"n_days":>8}'
+          f'{"static s":>10}{"dynamic s":>11}{"RSS MB":>9}{"DB MB":>9}')
+    for param, rows in results.items():
+        for r in rows:
+            print(f'{param:<10}{r["n_users"]:>10}{r["n_authors"]:>10}{r["n_days"]:>8}'
+                  f'{r["static_s"]:>10.2f}{r["dynamic_s"]:>11.2f}'
+                  f'{r["rss_mb"] or float("nan"):>9.1f}{r["db_mb"]:>9.2f}')
+
+    # Fit the growth exponents
+    # ------------------------
+    print()
+    print('Growth exponents (y ~ x^k)')
+    for param, rows in results.items():
+        x    = [r[param] for r in rows]
+        fits = {k: fit_exponent(x, [r[k] for r in rows]) for k in MEASURES}
+        print(f'  {param:<10}' + ''.join(f'{k}: {v:>5.2f}   ' if v is not None else f'{k}:   n/a   '
+                                         for k, v in fits.items()))
+
+        largest = max_size_for_budget(x, [r['rss_mb'] for r in rows], args.memory_budget)
+        if largest is not None:
+            print(f'  {"":<10}largest {param} within {args.memory_budget:.0f} MB '
+                  f'(others at base): ~{largest:,}')
+
+    print()
+    print(f'Table written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+'''
+This file is a local, asyncio-based service around simulate_dynamic, for when
+teams submit strategies while the game runs rather than through blocking
+cli.py commands.
+
+A GameService runs one game. It answers, concurrently
+  - strategy submissions (submit_strategy): submissions are queued, and
+    pending ones are coalesced into a single run - every submission that
+    arrived within batch_window seconds of the first is added to the game
+    (in the order received, so a team's latest submission wins), then the
+    next days_per_run days are simulated with generate_pvs. Runs execute on
+    a process pool, one at a time per game (days must be simulated in
+    order), while the event loop keeps serving; a submission resolves once
+    its run is done
+  - data queries (dashboard, leaderboard, status): answered from rollups
+    cached in memory, so reads never wait for a run in progress; the cache
+    is refreshed from the database (see rollups.py) after every run
+
+Several services (eg: one per game, with sharded=True so that each game is in
+its own shard, see shards.py) can share one process pool, so that different
+games are simulated concurrently.
+
+LocalClient is a stand-in for a team's front end, and load_test drives every
+team of a game through it to measure the service's latencies.
+
+Usage
+    python service.py --game-id 1 --submissions 5 --reads 20
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import multiprocessing
+import random
+import time
+
+import numpy as np
+
+# ---------------------------
+# -  Section 1; workers     -
+# ---------------------------
+
+def _routing(game_id, database):
+    '''
+    Returns a context manager routing the current process to the database
+    of a game; database is a dictionary with either the url of the
+    database, or the catalog url and shard directory of a sharded setup
+    '''
+    import models as m
+
+    if 'catalog_url' in database:
+        import shards
+        shards.CATALOG_URL = database['catalog_url']
+        shards.SHARD_DIR   = database['shard_dir']
+        return shards.routed(game_id)
+
+    if str(m.get_engine().url) != database['url']:
+        m.use_database(database['url'])
+    return contextlib.nullcontext()
+
+def _last_day(db, game_id):
+    '''
+    Returns the last day of a game with rollups (ie: simulated), or None
+    '''
+    import sqlalchemy as sa
+
+    import models as m
+
+    return db.execute(sa.select(sa.func.max(m.DailyRollup.day))
+                        .where(m.DailyRollup.game_id == game_id)).scalar()
+
+def run_batch(game_id, submissions, start, end, database):
+    '''
+    Adds a batch of strategy submissions (dictionaries of the arguments of
+    simulate_dynamic.add_strategy) to a game, in a single transaction, then
+    simulates days start to end (excluded). Runs in a worker process
+    
+    If the strategies can't be added, none is, and the exception is raised.
+    Once they are added, a failed simulation doesn't remove them: returns a
+    dictionary with the ids of the new strategies, the error of the
+    simulation, if any (as a string), and the day to resume from (end, or
+    the day after the last one the failed simulation completed)
+    '''
+    import models as m
+    import simulate_dynamic as sd
+
+    with _routing(game_id, database):
+        strategy_ids = sd.add_strategies(submissions)
+
+        error, resume = None, end
+        if end > start:
+            try:
+                # generate_pvs reloads the history it needs (see PVCache)
+                sd.generate_pvs(game_id, start, end)
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                # Days are committed one by one; resume after the last one
+                with m.Session() as db:
+                    last_day = _last_day(db, game_id)
+                resume = max(start, 0 if last_day is None else last_day + 1)
+
+    return {'strategy_ids': strategy_ids, 'error': error, 'day': resume}
+
+def read_rollups(game_id, database):
+    '''
+    Reads everything the service caches: the game's length, its teams, the
+    leaderboard, and the dashboard of every team
+    '''
+    import models as m
+    import rollups
+
+    with _routing(game_id, database):
+        with m.Session() as db:
+            game     = db.get(m.Game, game_id)
+            n_days   = game.n_days
+            team_ids = [t.id for t in game.teams]
+            last_day = _last_day(db, game_id)
+
+        leaderboard = rollups.leaderboard(game_id)
+        dashboards  = {t: rollups.dashboard(t) for t in team_ids}
+
+    return {'n_days'      : n_days,
+            'team_ids'    : team_ids,
+            'last_day'    : last_day,
+            'leaderboard' : leaderboard,
+            'dashboards'  : dashboards}
+
+def process_pool(workers=None):
+    '''
+    Returns a process pool for simulation runs; workers are spawned, so
+    that they don't inherit the service's database connections
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+
+# ---------------------------
+# -  Section 2; service     -
+# ---------------------------
+
+class GameService:
+    '''
+    Runs a game; see the top of this file
+      - executor     : the process pool to run simulations on (by default,
+                       a pool of its own, with a single worker)
+      - sharded      : whether the game is in a shard (see shards.py)
+      - days_per_run : the number of days each run simulates
+      - batch_window : how long, in seconds, a run waits for more
+                       submissions after the first
+    '''
+
+    def __init__(self, game_id, executor=None, sharded=False, days_per_run=1, batch_window=0.2):
+        import models as m
+
+        self.game_id      = game_id
+        self.days_per_run = days_per_run
+        self.batch_window = batch_window
+
+        self._own_executor = executor is None
+        self.executor      = executor or process_pool(1)
+
+        if sharded:
+            import shards
+            self.database = {'catalog_url': shards.CATALOG_URL, 'shard_dir': shards.SHARD_DIR}
+        else:
+            self.database = {'url': m.get_engine().url.render_as_string(hide_password=False)}
+
+        self.day     = None
+        self.running = False
+        self.n_runs  = 0
+        self.cache   = None
+
+        self._queue  = None
+        self._runner = None
+
+    async def start(self):
+        '''
+        Loads the cache, and starts serving submissions. The game resumes
+        from the day after its last rollup
+        '''
+        await self.refresh()
+        last_day = self.cache['last_day']
+        self.day = 0 if last_day is None else last_day + 1
+
+        self._queue  = asyncio.Queue()
+        self._runner = asyncio.create_task(self._run_loop())
+
+    async def stop(self):
+        '''
+        Waits for pending submissions to be run, then stops the service
+        '''
+        await self._queue.join()
+        self._runner.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._runner
+        if self._own_executor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def refresh(self):
+        '''
+        Reloads the cached rollups from the database
+        '''
+        loop = asyncio.get_running_loop()
+        self.cache = await loop.run_in_executor(None, read_rollups, self.game_id, self.database)
+
+    # Submissions
+    # -----------
+
+    async def submit_strategy(self, team_id, cost, ads, free_pvs, segment=None, priority=0):
+        '''
+        Submits a strategy for a team, and waits for the run that adds it.
+        Invalid submissions raise a ValueError, and are never queued.
+        Returns a dictionary with
+          - strategy_id : the id of the new strategy
+          - days        : the days (start, end excluded) simulated in the
+                          run
+          - error       : None, or the error that stopped the run's
+                          simulation (the strategy was still added)
+        '''
+        import strategy_rules
+
+        if team_id not in self.cache['team_ids']:
+            raise ValueError(f'Game {self.game_id} has no team {team_id}')
+        strategy_rules.check_segment(segment)
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((dict(team_id=team_id, cost=cost, ads=ads, free_pvs=free_pvs,
+                                    segment=segment, priority=priority), future))
+        return await future
+
+    async def _run_loop(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+
+            # Coalesce the submissions that arrive shortly after the first
+            await asyncio.sleep(self.batch_window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            start = self.day
+            end   = max(start, min(start + self.days_per_run, self.cache['n_days']))
+
+            self.running = True
+            try:
+                out = await loop.run_in_executor(self.executor, run_batch, self.game_id,
+                                                 [s for s, _ in batch], start, end, self.database)
+                self.n_runs += 1
+                self.day     = out['day']
+                await self.refresh()
+
+                for (_, future), strategy_id in zip(batch, out['strategy_ids']):
+                    if not future.done():
+                        future.set_result({'strategy_id' : strategy_id,
+                                           'days'        : (start, self.day),
+                                           'error'       : out['error']})
+            except Exception as e:
+                # Either nothing was added (see run_batch), or the cache
+                # couldn't be refreshed (the day has still moved on); no
+                # submission is left waiting, and the loop goes on
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                self.running = False
+                for _ in batch:
+                    self._queue.task_done()
+
+    # Queries
+    # -------
+
+    async def dashboard(self, team_id):
+        '''
+        Returns the cached dashboard of a team (see rollups.dashboard)
+        '''
+        return self.cache['dashboards'][team_id]
+
+    async def leaderboard(self):
+        '''
+        Returns the cached leaderboard of the game (see rollups.leaderboard)
+        '''
+        return self.cache['leaderboard']
+
+    async def status(self):
+        return {'game_id' : self.game_id,
+                'day'     : self.day,
+                'running' : self.running,
+                'pending' : self._queue.qsize(),
+                'n_runs'  : self.n_runs}
+
+# ---------------------------
+# -  Section 3; load test   -
+# ---------------------------
+
+class LocalClient:
+    '''
+    A stand-in for a team's front end: submits random strategies, and reads
+    its dashboard and the leaderboard in between, recording the latency of
+    every call
+    '''
+
+    def __init__(self, service, team_id, seed=0):
+        self.service   = service
+        self.team_id   = team_id
+        self.rng       = random.Random(seed)
+        self.latencies = {'submit': [], 'read': []}
+
+    async def _timed(self, kind, coro):
+        t_0 = time.perf_counter()
+        out = await coro
+        self.latencies[kind].append(time.perf_counter() - t_0)
+        return out
+
+    async def read(self, n_reads, think_time):
+        for _ in range(n_reads):
+            await self._timed('read', self.service.dashboard(self.team_id))
+            await self._timed('read', self.service.leaderboard())
+            await asyncio.sleep(self.rng.uniform(0, think_time))
+
+    async def play(self, n_submissions, n_reads, think_time=0.05):
+        '''
+        Submits n_submissions strategies, one after the other, while reading
+        n_reads times (dashboard and leaderboard) in the meantime
+        '''
+        async def submit():
+            for _ in range(n_submissions):
+                await asyncio.sleep(self.rng.uniform(0, think_time))
+                await self._timed('submit', self.service.submit_strategy(self.team_id,
+                                                                         cost     = self.rng.choice([5, 9, 15]),
+                                                                         ads      = self.rng.choice([0, 3, 6]),
+                                                                         free_pvs = self.rng.choice([3, 6, 12, 24])))
+
+        await asyncio.gather(submit(), self.read(n_reads, think_time))
+
+def _stats(latencies):
+    if not latencies:
+        return {'n': 0}
+    a = np.array(latencies)
+    return {'n'      : len(a),
+            'mean_s' : a.mean(),
+            'p50_s'  : np.quantile(a, 0.5),
+            'p95_s'  : np.quantile(a, 0.95),
+            'max_s'  : a.max()}
+
+async def load_test(game_id, n_submissions=3, n_reads=20, sharded=False, days_per_run=1, batch_window=0.2,
+                    executor=None):
+    '''
+    Drives every team of a game through a LocalClient at once. Returns the
+    latency statistics of submissions and reads, and the number of runs the
+    submissions were coalesced into
+    '''
+    t_0 = time.perf_counter()
+    async with GameService(game_id, executor, sharded, days_per_run, batch_window) as service:
+        clients = [LocalClient(service, t, seed=t) for t in service.cache['team_ids']]
+        await asyncio.gather(*[c.play(n_submissions, n_reads) for c in clients])
+        status = await service.status()
+
+    return {'teams'       : len(clients),
+            'submissions' : _stats([x for c in clients for x in c.latencies['submit']]),
+            'reads'       : _stats([x for c in clients for x in c.latencies['read']]),
+            'runs'        : status['n_runs'],
+            'days'        : status['day'],
+            'wall_s'      : time.perf_counter() - t_0}
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the game service')
+    parser.add_argument('--game-id', type=int, default=1, help='Game to run')
+    parser.add_argument('--sharded', action='store_true', help='The game is in a shard (see shards.py)')
+    parser.add_argument('--submissions', type=int, default=3, help='Strategies submitted by each team')
+    parser.add_argument('--reads', type=int, default=20, help='Dashboard and leaderboard reads by each team')
+    parser.add_argument('--days-per-run', type=int, default=1, help='Days simulated by each run')
+    parser.add_argument('--batch-window', type=float, default=0.2, help='Seconds to wait for more submissions')
+    args = parser.parse_args()
+
+    out = asyncio.run(load_test(args.game_id, args.submissions, args.reads, args.sharded,
+                                args.days_per_run, args.batch_window))
+
+    print(f'{out["teams"]} teams, {out["runs"]} runs, game at day {out["days"]}, {out["wall_s"]:.2f}s')
+    for kind in ['submissions', 'reads']:
+        s = out[kind]
+        if s['n']:
+            print(f'{kind:<12} n={s["n"]:<5} mean={s["mean_s"]*1000:9.2f}ms  p50={s["p50_s"]*1000:9.2f}ms  '
+                  f'p95={s["p95_s"]*1000:9.2f}ms  max={s["max_s"]*1000:9.2f}ms')
+
+if __name__ == '__main__':
+    main()
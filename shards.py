@@ -0,0 +1,278 @@
+'''
+This file shards games across databases. With every game in game.db, two
+classes simulating days at the same time serialize on SQLite's write lock; with
+sharding, each game lives in its own database (its shard), so different games
+can be generated and simulated concurrently.
+
+  - The catalog (CATALOG_URL) is the one global database. It holds the
+    registry of games - each game's id, name and shard - and the players,
+    with the teams they play in (a game id and a team id in that game's shard)
+  - Game ids are allocated by the catalog, so they are unique across shards;
+    every other id (teams, users, pageviews, ...) is local to a shard
+  - Each shard is a database in SHARD_DIR with the full schema of models,
+    behind its own engine and connection pool (POOL_SIZE connections). By
+    default every game gets its own shard; with N_SHARDS set, games are
+    spread over that many shards by id instead
+  - routed(game_id) routes the current thread (or asyncio task) to the
+    game's shard, with models.use_engine: every Session opened without a
+    bind, and every run_sql or stream_sql, then uses the shard. The rest of
+    the code needs no change - eg: with routed(3): generate_pvs(3)
+
+Shards use SQLite's write-ahead log, so a game's rollups can be read while
+the game is being simulated.
+
+Usage
+    python cli.py create_db --sharded
+    python cli.py create_game --sharded --name 'Section A'
+    python cli.py seed_pvs --sharded --game-id 2
+'''
+
+import contextlib
+import datetime
+import os
+import threading
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+import models as m
+
+CATALOG_URL = 'sqlite:///catalog.db'
+SHARD_DIR   = 'shards'
+POOL_SIZE   = 5
+
+# Number of shards to spread games over; None for one shard per game
+N_SHARDS    = None
+
+catalog_registry = sa_orm.registry()
+CatalogBase      = catalog_registry.generate_base()
+
+class CatalogGame(CatalogBase):
+    '''
+    A game, and the shard it lives in
+    '''
+
+    __tablename__ = 'catalog_game'
+
+    id      = sa.Column(sa.Integer, primary_key=True)
+    name    = sa.Column(sa.String(50))
+    shard   = sa.Column(sa.String(50))
+    created = sa.Column(sa.DateTime, default=datetime.datetime.utcnow)
+
+class CatalogPlayer(CatalogBase):
+    '''
+    A player, who might play in teams of several games
+    '''
+
+    __tablename__ = 'catalog_player'
+
+    id              = sa.Column(sa.Integer, primary_key=True)
+    email           = sa.Column(sa.String(50), nullable=False, unique=True)
+    hashed_password = sa.Column(sa.String(50), nullable=False)
+
+    teams = sa_orm.relationship('CatalogPlayerTeam', back_populates='player')
+
+class CatalogPlayerTeam(CatalogBase):
+    '''
+    A player's membership of a team; team_id is the id of the team in the
+    shard of game_id
+    '''
+
+    __tablename__ = 'catalog_player_team'
+
+    player_id = sa.Column(sa.ForeignKey('catalog_player.id'), primary_key=True)
+    game_id   = sa.Column(sa.ForeignKey('catalog_game.id'), primary_key=True)
+    team_id   = sa.Column(sa.Integer, primary_key=True)
+
+    player = sa_orm.relationship('CatalogPlayer', back_populates='teams')
+
+# ---------------------------
+# -  Section 1; engines     -
+# ---------------------------
+
+_lock           = threading.Lock()
+_catalog_engine = None
+_shard_engines  = {}
+_game_shards    = {}
+
+def _sqlite_engine(url, pool_size):
+    '''
+    Creates an engine with a connection pool that can be shared across
+    threads, using SQLite's write-ahead log
+    '''
+    engine = sa.create_engine(url,
+                              poolclass    = sa.pool.QueuePool,
+                              pool_size    = pool_size,
+                              connect_args = {'check_same_thread': False, 'timeout': 30})
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+    return engine
+
+def catalog_engine():
+    global _catalog_engine
+
+    with _lock:
+        if _catalog_engine is None:
+            _catalog_engine = _sqlite_engine(CATALOG_URL, POOL_SIZE)
+        return _catalog_engine
+
+def catalog_session():
+    return m.Session(bind=catalog_engine())
+
+def shard_name(game_id):
+    if N_SHARDS is None:
+        return f'game_{game_id}'
+    return f'shard_{game_id % N_SHARDS}'
+
+def shard_url(shard):
+    return f'sqlite:///{os.path.join(SHARD_DIR, shard)}.db'
+
+def shard_engine(shard):
+    '''
+    Returns the engine (and so the connection pool) of a shard, creating
+    the shard's database and schema the first time
+    '''
+    with _lock:
+        if shard not in _shard_engines:
+            os.makedirs(SHARD_DIR, exist_ok=True)
+            engine = _sqlite_engine(shard_url(shard), POOL_SIZE)
+            m.mapper_registry.metadata.create_all(engine)
+            _shard_engines[shard] = engine
+        return _shard_engines[shard]
+
+def dispose():
+    '''
+    Closes every pooled connection, eg: before forking
+    '''
+    global _catalog_engine
+
+    with _lock:
+        for engine in list(_shard_engines.values()) + [_catalog_engine]:
+            if engine is not None:
+                engine.dispose()
+        _shard_engines.clear()
+        _game_shards.clear()
+        _catalog_engine = None
+
+# ---------------------------
+# -  Section 2; registry    -
+# ---------------------------
+
+def create_catalog():
+    '''
+    Creates an empty catalog, dropping any previous one (the shards
+    themselves are left in SHARD_DIR)
+    '''
+    catalog_registry.metadata.drop_all(catalog_engine())
+    catalog_registry.metadata.create_all(catalog_engine())
+    _game_shards.clear()
+
+def register_game(name):
+    '''
+    Adds a game to the catalog, and returns its id; the game is assigned
+    its shard, which is created if needed
+    '''
+    with catalog_session() as db:
+        game = CatalogGame(name=name)
+        db.add(game)
+        db.flush()
+        game.shard = shard_name(game.id)
+        db.commit()
+        game_id, shard = game.id, game.shard
+
+    shard_engine(shard)
+    _game_shards[game_id] = shard
+
+    return game_id
+
+def shard_for(game_id):
+    '''
+    Returns the shard of a game, as registered in the catalog
+    '''
+    if game_id not in _game_shards:
+        with catalog_session() as db:
+            shard = db.execute(sa.select(CatalogGame.shard).where(CatalogGame.id == game_id)).scalar()
+        if shard is None:
+            raise ValueError(f'Game {game_id} is not in the catalog')
+        _game_shards[game_id] = shard
+
+    return _game_shards[game_id]
+
+def engine_for(game_id):
+    return shard_engine(shard_for(game_id))
+
+def session(game_id):
+    '''
+    Returns a new session on a game's shard
+    '''
+    return m.Session(bind=engine_for(game_id))
+
+@contextlib.contextmanager
+def routed(game_id):
+    '''
+    Routes the current thread or task to a game's shard within the block;
+    see the top of this file
+    '''
+    with m.use_engine(engine_for(game_id)):
+        yield
+
+def games():
+    '''
+    Returns a DataFrame of the games in the catalog, with their shard
+    '''
+    import pandas as pd
+
+    with catalog_session() as db:
+        rows = db.execute(sa.select(CatalogGame.id, CatalogGame.name, CatalogGame.shard, CatalogGame.created)
+                            .order_by(CatalogGame.id)).fetchall()
+
+    return pd.DataFrame(rows, columns=['game_id', 'name', 'shard', 'created'])
+
+# ---------------------------
+# -  Section 3; games       -
+# ---------------------------
+
+def create_game(name, seed, n_days, n_days_p0, n_authors, n_users, user_chunk_size=None,
+                sparse_top_k=None, sparse_threshold=None):
+    '''
+    Registers a game in the catalog, and generates it in its shard (see
+    simulate_static.game_static, which takes the same arguments). Returns
+    the id of the game
+    '''
+    import simulate_static as ss
+
+    game_id = register_game(name)
+
+    with routed(game_id):
+        ss.game_static(name, seed, n_days, n_days_p0, n_authors, n_users,
+                       user_chunk_size or ss.USER_CHUNK_SIZE, sparse_top_k, sparse_threshold,
+                       game_id=game_id)
+
+    return game_id
+
+def add_player(email, hashed_password):
+    '''
+    Adds a player to the catalog, and returns their id
+    '''
+    with catalog_session() as db:
+        player = CatalogPlayer(email=email, hashed_password=hashed_password)
+        db.add(player)
+        db.commit()
+        return player.id
+
+def join_team(player_id, game_id, team_id):
+    '''
+    Adds a player to a team of a game
+    '''
+    with session(game_id) as db:
+        if db.get(m.Team, team_id) is None:
+            raise ValueError(f'Game {game_id} has no team {team_id}')
+
+    with catalog_session() as db:
+        db.merge(CatalogPlayerTeam(player_id=player_id, game_id=game_id, team_id=team_id))
+        db.commit()
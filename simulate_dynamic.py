@@ -1,6 +1,17 @@
-import random, itertools
+import itertools
 
-from models import UserStrategy, Pageview
+import numpy as np
+
+import candidates
+import compaction
+import popularity
+import profiling
+import progress
+import rollups
+import strategy_rules
+import views
+import visits
+from models import (Session, BaseStrategy, Game, Team, Strategy, UserStrategy, Pageview)
 
 # A Session is a visit to a site that might have one or more pageviews.
 #
@@ -60,136 +71,472 @@ from models import UserStrategy, Pageview
 # This is driven by income, media consumption proclivities, and affinity for the publication. In
 # the real world, the strongest available predictor is the number of sessions over a period of time.
 # Buying additional data around income and media proclivities adds considerable signal.
+#
+# DF: Conversions are decided by PageviewBatch below, with a logistic model on income, ad
+# sensitivity and the number of prior sessions, calibrated so that a typical user (income around
+# the median, average ad sensitivity, 5 prior sessions) converts about one time in ten
+
+# Calibration of article scores (see simulate_session); a user clicks an article if its
+# score is above average by one standard deviation, and each click raises the bar by half a
+# standard deviation
+SCORE_AVERAGE             = 0.25651818456545666
+SCORE_STDDEV              = 0.14619941832318883
+CLICK_STEP                = 0.5   # in standard deviations, per click
+
+# Weights of the user's interest in the article's topic, of the author's quality, and of the
+# author's popularity (their share of the team's recent pageviews; see popularity.py) in
+# article scores
+INTEREST_WEIGHT           = 2
+QUALITY_WEIGHT            = 0.02
+POPULARITY_WEIGHT         = 0.5
+
+CONVERSION_INTERCEPT      = -3.0
+CONVERSION_INCOME         = 0.5   # per log of household income relative to the median
+CONVERSION_AD_SENSITIVITY = 0.3   # per unit of ad sensitivity above the average (3)
+CONVERSION_SESSIONS       = 0.5   # per log of 1 + prior sessions
+
+MEDIAN_INCOME             = 50000
+
+# Offset added to the game seed to seed the order in which sessions see articles (see
+# session_rng), so that it is not drawn from the same sequence as the visit calendar
+SESSION_SEED_OFFSET       = 104729
+
+def session_rng(game_seed, *keys):
+    '''
+    Returns the random generator that orders the articles of sessions, seeded from the
+    game's seed and keys (eg: the day). generate_pvs draws one per day, and runs the day's
+    sessions in user id order, so the order only depends on the game and the day
+    '''
+    return np.random.default_rng([(int(game_seed) + SESSION_SEED_OFFSET) % 2**32, *keys])
+
+def income_value(band):
+    '''
+    Converts a household income band (eg: '50000 to 54999', '200000 and
+    over') into the dollar value at its middle; unknown incomes are
+    treated as the median
+    '''
+    if not band:
+        return MEDIAN_INCOME
+    
+    bounds = [int(b) for b in band.split() if b.isdigit()]
+    if len(bounds) == 2:
+        return (bounds[0] + bounds[1])/2
+    return bounds[0] + 2500
+
+def conversion_probability(income, ad_sensitivity, prior_sessions):
+    '''
+    Returns the probability that users hitting the paywall subscribe;
+    each argument is an array with one value per user
+    '''
+    logit = (CONVERSION_INTERCEPT
+                + CONVERSION_INCOME * np.log(np.maximum(income, 1000)/MEDIAN_INCOME)
+                + CONVERSION_AD_SENSITIVITY * (np.asarray(ad_sensitivity, dtype=float) - 3)
+                + CONVERSION_SESSIONS * np.log1p(prior_sessions))
+    return 1/(1 + np.exp(-logit))
+
+class PageviewBatch:
+    '''
+    Collects the pageviews of a day, then (in finalize) decides for every
+    team, in one vectorized pass each
+      - which strategy applies to each pageview (see strategy_rules), and
+        so its ads and whether it hits the paywall
+      - which paywall hits lead to a subscription, with a single draw from
+        the team's random stream (see rand_utils)
+    
+    Only a user's first paywall hit of the day on a team can convert, and
+    hits are decided in user id order, so the conversions only depend on
+    the hits and on the team's stream. Pageviews are only added to the
+    database once they are final
+    '''
+    def __init__(self):
+        # team id -> list of (user, article, duration, prior pageviews,
+        #                     prior sessions, already subscribed)
+        self.candidates = {}
+
+    def add(self, team, user, article, duration, prior_pvs, prior_sessions, subscribed):
+        self.candidates.setdefault(team.id, []).append(
+                                (user, article, duration, prior_pvs, prior_sessions, subscribed))
+
+    def finalize(self, db, teams, day, strategies, subscriptions, popularities=None):
+        '''
+        Assigns strategies and decides conversions for every team, records
+        conversions (as UserStrategy rows, and in subscriptions, which maps
+        user ids to the set of teams they are subscribed to) and adds the
+        day's pageviews to db. strategies maps team ids to their strategies
+        (see views.load_strategies). If given, popularities maps team ids to
+        their popularity.Popularity, which is moved on by a day with the
+        day's pageviews, and saved on the team. Returns the number of
+        conversions
+        '''
+        n_conversions = 0
+        for team in teams:
+            candidates = self.candidates.get(team.id)
+            if popularities is not None:
+                popularities[team.id].add_day([c[1].author_id for c in candidates or ()])
+                popularities[team.id].save(team)
+            if not candidates:
+                continue
+            users, articles, durations, prior_pvs, prior_sessions, subscribed = zip(*candidates)
+            
+            # Strategies
+            # ----------
+            rules = strategy_rules.compiled(team.id, strategies[team.id])
+            s = rules.assign({'age'              : np.array([u.age for u in users], dtype=object),
+                              'household_income' : np.array([u.household_income for u in users], dtype=object),
+                              'topic_id'         : np.array([a.topic_id for a in articles])})
+            
+            saw_paywall = ~np.array(subscribed) & (np.array(prior_pvs) >= rules.free_pvs[s])
+            ads_seen    = rules.ads[s]
+            
+            pageviews = [Pageview(team_id     = team.id,
+                                  article_id  = a.id,
+                                  day         = day,
+                                  duration    = d,
+                                  ads_seen    = int(ads),
+                                  saw_paywall = bool(paywall),
+                                  converted   = False,
+                                  user_id     = u.id)
+                            for u, a, d, ads, paywall in zip(users, articles, durations, ads_seen, saw_paywall)]
+            
+            # Conversions
+            # -----------
+            first_hit = {}
+            for i in np.flatnonzero(saw_paywall):
+                first_hit.setdefault(users[i].id, i)
+            hits = [first_hit[user_id] for user_id in sorted(first_hit)]
+            
+            if hits:
+                p = conversion_probability(np.array([income_value(users[i].household_income) for i in hits]),
+                                           np.array([users[i].ad_sensitivity for i in hits]),
+                                           np.array([prior_sessions[i] for i in hits]))
+                converted = np.atleast_1d(team.generate_rv('uniform', n=len(hits))) < p
+                
+                for i, c in zip(hits, converted):
+                    if c:
+                        pageviews[i].converted = True
+                        db.add(UserStrategy(user_id=users[i].id, strategy_id=int(rules.ids[s[i]]), start_day=day))
+                        subscriptions.setdefault(users[i].id, set()).add(team.id)
+                        n_conversions += 1
+            
+            db.add_all(pageviews)
+        
+        self.candidates = {}
+        
+        return n_conversions
 
 class SessionSimulator:
-    def __init__(self, user, game):
+    '''
+    Simulates the sessions of a user (a views.UserView) on articles given
+    as views.ArticleView. Pageviews are collected in batch (a PageviewBatch),
+    which assigns their strategies and decides conversions for the whole day.
+    popularities maps team ids to the popularity.Popularity of their authors;
+    without it, authors have no popularity. rng (see session_rng) orders the
+    articles of each session; without it, each session draws its own from
+    the game, the day and the user
+    '''
+    def __init__(self, user, game, batch, subscribed=None, popularities=None, rng=None):
         self.user = user
         self.game = game
+        self.batch = batch
+        # Teams the user is subscribed to; pass the same set to every
+        # session of a user so that conversions carry over from day to day
+        self.subscribed = subscribed if subscribed is not None else set(user.subscriptions)
+        self.popularities = popularities or {}
+        self.rng = rng
 
-    def topics_dict(self):
-        td = {}
-        for user_topic in self.user.topics:
-            td[user_topic.topic.name] = user_topic.prob
-        return td
-
-    def pageview(self, db, score, day, article, team, prior_pvs):
-        strategy = team.get_strategy_for_user(self.user, article, day)
+    def pageview(self, db, score, day, article, team, prior_pvs, prior_sessions):
         duration = article.wordcount / 230 * 2 * score # 230 wpm of reading
-        saw_paywall = False
-        converted = False
-        user_strategy = self.user.teams \
-            .filter(UserStrategy.team_id == team.id) \
-            .first()
-        if (not user_strategy):
-            saw_paywall = (len(prior_pvs) >= strategy.free_pvs)
-            if (saw_paywall):
-                converted = random.random() > 0.1 # one in ten chance of converting
-                if (converted):
-                    db.add(UserStrategy(team=team, user=self.user, strategy=strategy, start_day=day))
-        db.add(
-            Pageview(
-                team=team,
-                article=article,
-                day=day,
-                duration=duration,
-                ads_seen=strategy.ads,
-                saw_paywall=saw_paywall,
-                converted=converted,
-                user=self.user,
-            )
-        )
+        # the strategy, paywall and conversion are decided with the rest of
+        # the day's pageviews (see PageviewBatch)
+        self.batch.add(team, self.user, article, duration, len(prior_pvs), prior_sessions,
+                       team.id in self.subscribed)
 
     # This is the core of the dynamic logic which determines 
     def simulate_session(self, db, day, articles, cache_pvs = False):
         # sort articles by how much the user is likely to want to read
-        user_topics = self.user.topics_dict()
-        random.shuffle(articles)
+        user_topics = self.user.interests
+        rng = self.rng if self.rng is not None else session_rng(self.game.seed, day, self.user.id)
+        rng.shuffle(articles)
+        n_pvs = 0
+        # count, sum and sum of squares of the scores (see ScoreStats)
+        n_scores, score_sum, score_sq = 0, 0.0, 0.0
         for team in self.game.teams:
+            team_popularity = self.popularities.get(team.id)
             # For the first year simulation, we use a simple in-memory cache for pageviews
-            # so it doesn't take an actual year to run the sim
+            # so it doesn't take an actual year to run the sim (see PVCache)
             if (cache_pvs):
-                articles_seen = pv_cache.get(team, self.user, 30)
+                articles_seen = pv_cache.get(team, self.user, day, compaction.TRAILING_DAYS)
+                prior_sessions = pv_cache.n_sessions(team, self.user, day, compaction.TRAILING_DAYS)
             else:
-                prior_pvs = self.user.pageviews \
+                # Only the trailing window is kept pageview by pageview
+                # (see compaction.py)
+                prior_pvs = db.query(Pageview.article_id) \
+                    .filter(Pageview.user_id == self.user.id) \
                     .filter(Pageview.team_id == team.id) \
                     .filter(Pageview.day <= day) \
-                    .filter(Pageview.day <= 30) \
+                    .filter(Pageview.day >= day - compaction.TRAILING_DAYS) \
                     .all()
-                articles_seen = [pv.article.id for pv in prior_pvs]
-            score_average = 0.25651818456545666
-            score_stddev = 0.14619941832318883
-            score_cutoff = score_average + score_stddev
+                articles_seen = [article_id for article_id, in prior_pvs]
+                prior_sessions = db.query(Pageview.day) \
+                    .filter(Pageview.user_id == self.user.id) \
+                    .filter(Pageview.team_id == team.id) \
+                    .filter(Pageview.day < day) \
+                    .filter(Pageview.day >= day - compaction.TRAILING_DAYS) \
+                    .distinct() \
+                    .count()
+            score_cutoff = SCORE_AVERAGE + SCORE_STDDEV
             articles_clicked = []
             for article in articles:
                 # don't click the same headline twice
                 if article.id in articles_seen:
                     continue
                 score = sum((
-                    user_topics[article.topic.name] * 2,
-                    article.author.popularity * 0.5,
-                    article.author.quality * 0.02,
+                    user_topics[article.topic_id] * INTEREST_WEIGHT,
+                    article.author.quality * QUALITY_WEIGHT,
+                    team_popularity.share(article.author_id) * POPULARITY_WEIGHT if team_popularity is not None else 0,
                 ))
+                n_scores += 1
+                score_sum += score
+                score_sq += score * score
                 if (score > score_cutoff):
-                    self.pageview(db, score, day, article, team, articles_seen)
+                    self.pageview(db, score, day, article, team, articles_seen, prior_sessions)
                     articles_clicked.append(article.id)
                     # each subsequent article is harder to click
-                    score_cutoff += score_stddev * 0.5
-            pv_cache.append(team, self.user, articles_clicked)
+                    score_cutoff += SCORE_STDDEV * CLICK_STEP
+            pv_cache.append(team, self.user, day, articles_clicked)
+            n_pvs += len(articles_clicked)
+        pv_scores.add(n_scores, score_sum, score_sq)
+        return n_pvs
 
 class PVCache:
+    '''
+    The sessions of every team and user, as (day, ids of the articles read)
+    pairs, over the trailing window the simulation reads. Sessions include
+    those with no pageviews, so n_sessions counts the visits of the window,
+    whether or not they read the team's articles
+    
+    generate_pvs loads the cache from the database when it starts (see
+    load), so a run resuming from any day sees the same history as one
+    that simulated every day before it
+    '''
     teams = {}
     
-    def get(self, team, user, trailing_days):
+    def get(self, team, user, day, trailing_days):
         try:
-            return list(itertools.chain(*self.teams[team.id][user.id][-trailing_days:]))
+            return list(itertools.chain(*(a for d, a in self.teams[team.id][user.id] if d >= day - trailing_days)))
         except:
             return []
 
-    def append(self, team, user, articles):
+    def n_sessions(self, team, user, day, trailing_days):
+        try:
+            return sum(1 for d, a in self.teams[team.id][user.id] if day - trailing_days <= d < day)
+        except:
+            return 0
+
+    def append(self, team, user, day, articles):
         if team.id not in self.teams.keys():
             self.teams[team.id] = {}
         if user.id not in self.teams[team.id].keys():
             self.teams[team.id][user.id] = []
-        self.teams[team.id][user.id].append(articles)
+        sessions = self.teams[team.id][user.id]
+        sessions.append((day, articles))
+        # Sessions that left the window are never read again
+        while sessions[0][0] < day - compaction.TRAILING_DAYS:
+            sessions.pop(0)
+
+    def load(self, db, game, calendar, day):
+        '''
+        Replaces the cache with the sessions of a game's teams in the trailing
+        window before day: every visit of calendar (a visits.VisitCalendar),
+        with the articles read in it, from the game's pageviews. These days
+        are never compacted (see compaction.py)
+        '''
+        first = max(0, day - compaction.TRAILING_DAYS)
+        team_ids = [t.id for t in game.teams]
+        
+        read = {}
+        q = db.query(Pageview.team_id, Pageview.user_id, Pageview.day, Pageview.article_id) \
+            .filter(Pageview.team_id.in_(team_ids)) \
+            .filter(Pageview.day >= first) \
+            .filter(Pageview.day < day) \
+            .order_by(Pageview.id)
+        for team_id, user_id, d, article_id in q:
+            read.setdefault((team_id, user_id, d), []).append(article_id)
+        
+        self.teams = {t: {} for t in team_ids}
+        for d in range(first, day):
+            for user_id in calendar.visitors(d).tolist():
+                for team_id in team_ids:
+                    self.teams[team_id].setdefault(user_id, []).append((d, read.get((team_id, user_id, d), [])))
 
 pv_cache = PVCache()
 
+class ScoreStats:
+    '''
+    The running count, sum and sum of squares of the scores of the articles
+    sessions considered, from which generate_pvs reports their mean and
+    standard deviation (to calibrate SCORE_AVERAGE and SCORE_STDDEV)
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, n, total, total_sq):
+        self.n += n
+        self.total += total
+        self.total_sq += total_sq
+
+    def average(self):
+        return self.total / self.n
+
+    def stddev(self):
+        return max(0.0, self.total_sq / self.n - self.average() ** 2) ** 0.5
+
+pv_scores = ScoreStats()
+
 
 # From simulate.py
 
+def create_team(game_id, name, seed):
+    '''
+    Adds a team to a game. Every team starts with a strategy based on
+    BaseStrategy, which governs the initial period of the game
+    '''
+    with Session() as db:
+        game = db.get(Game, game_id)
+        team = Team(name=name, seed=seed)
+        team.strategies.append(Strategy(cost     = BaseStrategy.cost,
+                                        ads      = BaseStrategy.ads,
+                                        free_pvs = BaseStrategy.free_pvs))
+        game.teams.append(team)
+        db.commit()
+        return team.id
+
+def add_strategy(team_id, cost, ads, free_pvs, segment=None, priority=0):
+    '''
+    Adds a strategy to a team. It applies from the next simulated day to
+    the pageviews matching segment (every pageview if None), unless a
+    strategy with a higher priority also matches; see models.Strategy
+    '''
+    return add_strategies([dict(team_id=team_id, cost=cost, ads=ads, free_pvs=free_pvs,
+                                segment=segment, priority=priority)])[0]
+
+def add_strategies(strategies):
+    '''
+    Adds several strategies (dictionaries of the arguments of add_strategy)
+    in a single transaction: either every strategy is added, or, if any of
+    them is invalid, none is and a ValueError is raised. Returns the ids of
+    the new strategies
+    '''
+    for s in strategies:
+        strategy_rules.check_segment(s.get('segment'))
+    
+    with Session() as db:
+        added = []
+        for s in strategies:
+            team = db.get(Team, s['team_id'])
+            if team is None:
+                raise ValueError(f'There is no team {s["team_id"]}')
+            strategy = Strategy(cost     = s['cost'],
+                                ads      = s['ads'],
+                                free_pvs = s['free_pvs'],
+                                segment  = s.get('segment'),
+                                priority = s.get('priority') or 0)
+            team.strategies.append(strategy)
+            added.append(strategy)
+        db.commit()
+        return [strategy.id for strategy in added]
+
 # this has to have no memory so that we can use it during the simulation
-def generate_pvs(game, start = 0, end = N_DAYS_PERIOD_0):
+def generate_pvs(game_id = 1, start = 0, end = None, candidates_per_topic = None, min_recall = None):
+    '''
+    Simulates the sessions of every user visiting the site between days
+    start and end (excluded); who visits on which day is decided by the
+    game's visit calendar (see visits.py)
+    
+    Sessions only score the articles they could click (see candidates.py);
+    candidates_per_topic limits them to the best articles of each topic.
+    The recall of those limits is then measured every day (see
+    candidates.recall): on days it falls below min_recall (by default,
+    candidates.MIN_RECALL), sessions score every article they could click
+    instead, so that the limits never stray far from full scoring
+    '''
     with Session() as db:
-        game = db.get(Game, 1) # TODO: Make this a parameter
-        for day in tqdm(range(start, end)):
+        # Not Game.load: the game expires at every commit, and would then
+        # be refreshed with its whole graph
+        game = db.get(Game, game_id)
+        if end is None:
+            end = game.n_days_p0
+        
+        with profiling.phase('calendar') as p:
+            calendar = visits.build_calendar(game.id, end)
+            p.rows += len(calendar.user_ids)
+        
+        authors = views.load_authors(db, game.id)
+        users = views.load_users(db, game.id)
+        user_ids = np.array([u.id for u in users], dtype=np.int64)
+        subscriptions = {u.id: set(u.subscriptions) for u in users}
+        popularities = {t.id: popularity.Popularity.from_team(t, sorted(authors)) for t in game.teams}
+        index = candidates.CandidateIndex(candidates_per_topic)
+        if min_recall is None:
+            min_recall = candidates.MIN_RECALL
+        recalls = []
+        pv_scores.reset()
+        pv_cache.load(db, game, calendar, start)
+        
+        for day in progress.track(range(start, end), 'days'):
             # what events are live today?
-            events_today = db.query(Event) \
-                .where(Event.start <= day) \
-                .where(Event.end >= day) \
-                .where(Event.game_id == game.id) \
-                .all()
-            # what users are eligible to visit today?
-            users_today = db.query(User) \
-                .where(User.first_day <= day) \
-                .where(day < User.first_day + User.lifetime) \
-                .where(User.game_id == game.id) \
-                .all()
+            with profiling.phase('day.events') as p:
+                events_today = views.load_events(db, game.id, day)
+                p.rows += len(events_today)
+            # what users visit today?
+            with profiling.phase('day.users') as p:
+                users_today = [users[i] for i in np.searchsorted(user_ids, calendar.visitors(day))]
+                strategies = views.load_strategies(db, game.id)
+                p.rows += len(users_today)
             # what articles might they see?
-            if (len(events_today)):
-                longtail = min([e.start for e in events_today])
-            else:
-                longtail = day
-            articles_today = db.query(Article) \
-                .where(Article.day >= longtail) \
-                .where(Article.day <= day) \
-                .where(Article.game_id == game.id) \
-                .all()
+            with profiling.phase('day.articles') as p:
+                if (len(events_today)):
+                    longtail = min([e.start for e in events_today])
+                else:
+                    longtail = day
+                p.rows += index.update(db, game.id, longtail, day, authors)
+                # No author's popularity adds more than this to a score today
+                bonus = max([pop.shares().max() for pop in popularities.values()], default=0) * POPULARITY_WEIGHT
+                cutoff = SCORE_AVERAGE + SCORE_STDDEV
+                # Keep the per-topic limits only while they return enough
+                # of the articles users could click
+                limited = True
+                if candidates_per_topic is not None:
+                    recalls.append(candidates.recall(index, users_today, cutoff, bonus))
+                    limited = recalls[-1] >= min_recall
             
-            for user in users_today:
-                user.simulate_session(db, day, articles_today, True)
-            pv_scores = get_metric('pv_score')
-            db.commit()
+            with profiling.phase('day.sessions') as p:
+                batch = PageviewBatch()
+                rng = session_rng(game.seed, day)
+                for user in users_today:
+                    articles_user = index.for_user(user.interests, cutoff, bonus, limited)
+                    p.rows += SessionSimulator(user, game, batch, subscriptions[user.id], popularities, rng) \
+                                    .simulate_session(db, day, articles_user, True)
+            with profiling.phase('day.finalize') as p:
+                p.rows += batch.finalize(db, game.teams, day, strategies, subscriptions, popularities)
+            with profiling.phase('day.commit'):
+                db.commit()
+            with profiling.phase('day.rollups'):
+                rollups.update_rollups(db, game.id, day)
+                db.commit()
+            with profiling.phase('day.compaction') as p:
+                # Tomorrow's sessions only read the trailing window
+                p.rows += compaction.compact_before(db, game.id, day + 1 - compaction.TRAILING_DAYS)
+                db.commit()
         
-        pv_scores = get_metric('pv_score')
-        print(np.average(pv_scores))
-        print(np.std(pv_scores))
\ No newline at end of file
+        if pv_scores.n:
+            progress.note('pv_score', average=pv_scores.average(), stddev=pv_scores.stddev())
+        if recalls:
+            progress.note('candidates', per_topic=candidates_per_topic, min_recall=min_recall,
+                          recall_average=float(np.mean(recalls)), recall_min=min(recalls),
+                          days_unlimited=sum(r < min_recall for r in recalls))
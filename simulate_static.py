@@ -16,9 +16,17 @@ other functions in the file
 '''
 
 import models as m
+import profiling
+import progress
+import sparse
+import views
 
 import numpy as np
 
+# Users are generated, saved and released in chunks of this size, so that
+# memory does not grow with the number of users (see generate_users)
+USER_CHUNK_SIZE = 1000
+
 TOPIC_NAMES = ['Opinion', 'Politics', 'World Events', 'Business', 'Technology', 'Arts & Culture', 'Sports', 'Health', 'Home', 'Travel', 'Fashion', 'Food']
     
 # ---------------------------------
@@ -43,14 +51,37 @@ def article_vocab(game):
     '''
     return np.maximum(0, np.minimum(1, game.generate_rv('normal', loc=0.5, scale=0.2)))
 
-def article_author(topic):
+def article_author(topic, weights=None):
     '''
     Given the topic of an article, this function will simulate the
     author that wrote it
     
+    weights are the author probabilities returned by author_weights; pass
+    them when simulating many articles, so they are only computed once
+    
     It uses the randomization engine in the game
     '''
     
+    if weights is None:
+        weights = author_weights(topic.game)
+    
+    # Only authors with an expertise in the topic can be drawn
+    authors, author_probs = weights.row(topic.game.topics.index(topic))
+    
+    # Generate the author
+    author = topic.game.generate_rv('choice', l=[topic.game.authors[i] for i in authors],
+                                              p=author_probs)
+    
+    return author
+
+def author_weights(game):
+    '''
+    Returns the probability each author writes an article on each topic,
+    as a sparse.SparseRows matrix with a row per topic (in game.topics
+    order) and a column per author (in game.authors order). Only authors
+    with a stored expertise in a topic have an entry in its row
+    '''
+    
     # Note that
     #                         P(Topic | Author) P(Author)
     #   P(Author | Topic) = -------------------------------
@@ -58,17 +89,24 @@ def article_author(topic):
     #
     # With P(Topic) = sum over authors ( P(Topic | Author) P(Author) )
     
-    # First, create a list called numerators that finds P(Topic | Author) P(Author)
-    # for every author
-    numerators = [a.topic_expertise(topic) * a.productivity for a in topic.game.authors]
+    topic_rows = {t.id: i for i, t in enumerate(game.topics)}
     
-    # Use that to find the probability each author wrote this article
-    author_probs = [i/sum(numerators) for i in numerators]
+    # First, find P(Topic | Author) P(Author) for every stored expertise
+    rows, cols, numerators = [], [], []
+    for col, a in enumerate(game.authors):
+        for topic_id, t_e in a.topic_expertises.items():
+            rows.append(topic_rows[topic_id])
+            cols.append(col)
+            numerators.append(t_e.expertise * a.productivity)
     
-    # Generate the author
-    author = topic.game.generate_rv('choice', l=topic.game.authors, p=author_probs)
+    weights = sparse.SparseRows.from_coo(rows, cols, numerators, (len(game.topics), len(game.authors)))
     
-    return author
+    # Then divide each row by P(Topic)
+    topic_of = np.repeat(np.arange(len(game.topics)), np.diff(weights.indptr))
+    p_topic  = np.bincount(topic_of, weights=weights.data, minlength=len(game.topics))
+    weights.data /= p_topic[topic_of]
+    
+    return weights
     
 # Author
 # ------
@@ -139,14 +177,24 @@ def event_intensity(game):
     '''
     return np.minimum(0.9, game.generate_rv('exponential', loc=0.1, scale=0.2))
 
-def event_articles(event, day):
+def event_end(event):
+    '''
+    Returns the last day on which an event can lead to an article, i.e.,
+    the last day on which the time effect in event_articles is above 0.01
+    '''
+    
+    # Solve exp( - days_since_event / alpha ) = 0.01 for days_since_event,
+    # with alpha = -4/np.log(intensity)
+    return event.start + int(np.ceil(4*np.log(0.01)/np.log(event.intensity))) - 1
+
+def event_articles(event, day, game):
     '''
     Given a specific day, this function will simulate whether an article
-    will be generated by this event on that day, and then find the topic
-    of that article
+    will be generated by this event (a views.EventView) on that day, and
+    then find the topic of that article
     
     It will either return None if no article is generated, or else return
-    the topic in question
+    the id of the topic in question
     
     The game randomization engine will be used
     '''
@@ -164,37 +212,45 @@ def event_articles(event, day):
         return None
     else:
         # Check whether an article will be published
-        if event.game.generate_rv('uniform') > event.intensity*time_effect:
+        if game.generate_rv('uniform') > event.intensity*time_effect:
             return None
         else:
-            topics = []
-            relevances  = []
-            for t_r in event.topic_relevances:
-                topics.append(t_r.topic)
-                relevances.append(t_r.relevance)
-        
-            return event.game.generate_rv('choice',
-                                          l=topics,
-                                          p=relevances)
+            return game.generate_rv('choice',
+                                    l=event.topic_ids,
+                                    p=event.relevances)
 
 # Game
 # ----
 
-def game_static(name, seed, n_days, n_days_p0, n_authors, n_users):
+def game_static(name, seed, n_days, n_days_p0, n_authors, n_users, user_chunk_size=USER_CHUNK_SIZE,
+                sparse_top_k=None, sparse_threshold=None, game_id=None):
     '''
     This function accepts simulation parameters for a game, creates the game, and
     simulates all static elements
+    
+    Users are committed in chunks of user_chunk_size; the chunk size does not
+    affect the game that is generated
+    
+    If sparse_top_k and/or sparse_threshold are given, only the top author
+    expertises and user affinities are stored (see sparse.top_k)
+    
+    game_id is the id to give the game (eg: one allocated by the shard
+    catalog, see shards.py); by default, the database picks it
     '''
 
     with m.Session() as db:
         # Create the game
         # ---------------
-        game = m.game(name      = name,
+        game = m.Game(id        = game_id,
+                      name      = name,
                       seed      = seed,
                       n_days    = n_days,
                       n_days_p0 = n_days_p0,
                       n_authors = n_authors,
-                      n_users   = n_users)
+                      n_users   = n_users,
+                      
+                      sparse_top_k     = sparse_top_k,
+                      sparse_threshold = sparse_threshold)
         
         db.add(game)
         
@@ -202,95 +258,143 @@ def game_static(name, seed, n_days, n_days_p0, n_authors, n_users):
         
         # Create the topics
         # -----------------
-        print('Generating topics')
-        
-        for t_name in TOPIC_NAMES:
-            game.topics.append(m.Topic(name=t_name, game=game))
-        
-        db.commit()
+        with profiling.phase('topics') as p, progress.task('topics', len(TOPIC_NAMES)) as t:
+            for t_name in TOPIC_NAMES:
+                game.topics.append(m.Topic(name=t_name, game=game))
+                t.update()
+            
+            db.commit()
+            p.rows += len(TOPIC_NAMES)
         
         # Create the authors
         # ------------------
-        print('Generating authors')
-        
-        for a in range(game.n_authors):
-            author =  m.Author(name    = author_name(game),
-                               quality = author_quality(game))
-            game.authors.append(author)
+        with profiling.phase('authors') as p, progress.task('authors', game.n_authors) as t:
+            for a in range(game.n_authors):
+                author =  m.Author(name    = author_name(game),
+                                   quality = author_quality(game))
+                game.authors.append(author)
+                
+                # Generate author expertise for every topic          
+                add_author_expertises(author, game)
+                t.update()
+                        
+            # Add author productivities
+            add_author_productivities(game)
             
-            # Generate author expertise for every topic          
-            add_author_expertises(author, game)
-                    
-        # Add author productivities
-        add_author_productivities(game)
-        
-        db.commit()
+            db.commit()
+            p.rows += game.n_authors*(1 + len(game.topics))
         
         # Create the events
         # -----------------
-        print('Generating events')
-        
-        for day in tqdm(range(game.n_days)):
-            n_events = events_per_day(game)
-            
-            for _ in range(n_events):
-                event = m.Event(start     = day,
-                                intensity = event_intensity(game))
-                game.events.append(event)
+        with profiling.phase('events') as p:
+            for day in progress.track(range(game.n_days), 'events'):
+                n_events = events_per_day(game)
                 
-                # Generate topic relevances for every topic
-                add_event_relevances(event, game)
-                
-        db.commit()
+                for _ in range(n_events):
+                    event = m.Event(start     = day,
+                                    intensity = event_intensity(game))
+                    event.end = event_end(event)
+                    game.events.append(event)
+                    
+                    # Generate topic relevances for every topic
+                    add_event_relevances(event, game)
+                    
+            db.commit()
+            p.rows += len(game.events)*(1 + len(game.topics))
         
         # Create the articles
         # -------------------
-        print('Generating articles')
-        
-        for day in tqdm(range(game.n_days)):
-            # Find the articles that will be published
-            articles = [event_articles(event, day)
-                                  for event in game.events]
-            
-            # Simulate the articles
-            game.articles.extend([m.Article(topic     = t,
-                                            author    = article_author(t),
-                                            wordcount = article_wordcount(game),
-                                            vocab     = article_vocab(game))
-                                                                for t in articles if t is not None])
+        with profiling.phase('articles') as p:
+            weights = author_weights(game)
+            topics  = {t.id: t for t in game.topics}
+            events  = views.load_events(db, game.id)
             
-        db.commit()
+            for day in progress.track(range(game.n_days), 'articles'):
+                # Find the articles that will be published
+                articles = [event_articles(event, day, game)
+                                      for event in events]
+                
+                # Simulate the articles
+                game.articles.extend([m.Article(day       = day,
+                                                topic     = topics[t],
+                                                author    = article_author(topics[t], weights),
+                                                wordcount = article_wordcount(game),
+                                                vocab     = article_vocab(game))
+                                                                    for t in articles if t is not None])
+                
+            db.commit()
+            p.rows += len(game.articles)
             
         # Create the users
         # ----------------
-        print('Generating users')
-        
-        for _ in tqdm(range(game.n_users)):
-            user_demo = user_age_and_income(game)
-            user = m.User(ip                   = user_ip(game),
-                          agent                = user_agent(game),
-                          freq                 = user_freq(game),
-                          first_day            = user_first_day(game),
-                          ad_sensitivity       = user_ad_sensitivity(game),
-                          ad_blocked           = False,
-                          age                  = user_demo['age'],
-                          household_income     = user_demo['income'],
-                          media_consumption    = user_media_consumption(game),
-                          internet_usage_index = user_internet_usage_index(game))
-            
-            game.users.append(user)
-            
-            # Add author affinities
-            add_user_interests(user, game)
-            
-            # Add topic interests
-            add_user_affinities(user, game)
+        with profiling.phase('users') as p, progress.task('users', game.n_users) as t:
+            for users in generate_users(game, user_chunk_size):
+                # Count the rows while the users' collections are still
+                # in memory; the commit expires them
+                p.rows += sum(1 + len(u.topic_interests) + len(u.author_affinities) for u in users)
+                
+                # Save the chunk; once committed, nothing in the session
+                # refers to these users, so they are released when the
+                # chunk is dropped
+                db.add_all(users)
+                db.commit()
+                
+                t.update(len(users))
+                
+                del users
         
-        db.commit()
+        return game.id
 
 # User
 # ----
 
+def simulate_user(game):
+    '''
+    Simulates a single user of a game, with their topic interests and
+    author affinities. The user is linked to the game through game_id
+    only, so that it isn't added to (and kept alive by) game.users
+    '''
+    
+    user_demo = user_age_and_income(game)
+    user = m.User(game_id              = game.id,
+                  ip                   = user_ip(game),
+                  agent                = user_agent(game),
+                  freq                 = user_freq(game),
+                  first_day            = user_first_day(game),
+                  ad_sensitivity       = user_ad_sensitivity(game),
+                  ad_blocked           = False,
+                  age                  = user_demo['age'],
+                  household_income     = user_demo['income'],
+                  media_consumption    = user_media_consumption(game),
+                  internet_usage_index = user_internet_usage_index(game))
+    
+    # Add topic interests
+    add_user_interests(user, game)
+    
+    # Add author affinities
+    add_user_affinities(user, game)
+    
+    return user
+
+def generate_users(game, chunk_size=USER_CHUNK_SIZE):
+    '''
+    Generator simulating the game.n_users users of a game, which yields
+    them in lists of at most chunk_size users. Users are simulated in the
+    same order (and so with the same random draws) whatever the chunk
+    size, so the chunk size never changes the game
+    '''
+    
+    chunk = []
+    for _ in range(game.n_users):
+        chunk.append(simulate_user(game))
+        
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    
+    if chunk:
+        yield chunk
+
 def user_ip(game):
     return game.generate_rv('ipv4')
 
@@ -341,8 +445,13 @@ def add_author_expertises(author, game):
     # concentrated on some topics
     alpha = np.ones(len(game.topics))*0.3
     
-    for t, expertise in zip(game.topics, game.generate_rv('dirichlet', alpha=alpha)):
-        author.topic_expertises.append(m.AuthorTopic(topic=t, expertise=expertise))
+    # Only keep the top expertises if the game is sparse
+    keep, expertises = sparse.top_k(game.generate_rv('dirichlet', alpha=alpha),
+                                    game.sparse_top_k, game.sparse_threshold)
+    
+    for i, expertise in zip(keep, expertises):
+        t = game.topics[i]
+        author.topic_expertises[t.id] = m.AuthorTopic(topic_id=t.id, topic=t, expertise=expertise)
     
 
 # EventTopic
@@ -355,7 +464,7 @@ def add_event_relevances(event, game):
     alpha = np.ones(len(game.topics))*0.3
     
     for t, relevance in zip(game.topics, game.generate_rv('dirichlet', alpha=alpha)):
-        event.topic_relevances.append(m.EventTopic(topic=t, relevance=relevance))
+        event.topic_relevances[t.id] = m.EventTopic(topic_id=t.id, topic=t, relevance=relevance)
         
 # UserTopic
 # ---------
@@ -367,7 +476,7 @@ def add_user_interests(user, game):
     alpha = np.ones(len(game.topics))*0.8
     
     for t, interest in zip(game.topics, game.generate_rv('dirichlet', alpha=alpha)):
-        user.topic_interests.append(m.UserTopic(topic=t, interest=interest))
+        user.topic_interests[t.id] = m.UserTopic(topic_id=t.id, topic=t, interest=interest)
 
 # UserAuthor
 # ----------
@@ -376,7 +485,12 @@ def add_user_affinities(user, game):
 
     # Create an alpha parameter that ensures affinities will be
     # lumped on a few authors
-    alpha = np.ones(len(game.topics))*0.4
+    alpha = np.ones(len(game.authors))*0.4
+    
+    # Only keep the top affinities if the game is sparse
+    keep, affinities = sparse.top_k(game.generate_rv('dirichlet', alpha=alpha),
+                                    game.sparse_top_k, game.sparse_threshold)
     
-    for a, affinity in zip(game.authors, game.generate_rv('dirichlet', alpha=alpha)):
-        user.author_affinities.append(m.UserAuthor(author=a, affinity=affinity))    
+    for i, affinity in zip(keep, affinities):
+        a = game.authors[i]
+        user.author_affinities[a.id] = m.UserAuthor(author_id=a.id, author=a, affinity=affinity)
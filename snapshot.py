@@ -0,0 +1,345 @@
+'''
+This file writes and reads game snapshots - a versioned on-disk copy of the
+static part of a game (see simulate_static), stored as a directory of NumPy
+arrays plus a small JSON manifest.
+
+Reloading a game from SQLite means rehydrating thousands of ORM objects (every
+user with their topic interests and author affinities, every event with its
+topic relevances, ...). A snapshot instead stores each attribute as a column
+array, and each many-to-many table as a dense matrix
+  - user_interest[u, t]    : UserTopic.interest of user row u for topic row t
+  - user_affinity[u, a]    : UserAuthor.affinity of user row u for author row a
+  - author_expertise[a, t] : AuthorTopic.expertise
+  - event_relevance[e, t]  : EventTopic.relevance
+In games that store author expertises and user affinities sparsely (see
+sparse.py), user_affinity and author_expertise are instead sparse.SparseRows
+matrices, stored as their indptr, indices and data arrays - only the stored
+entries take space.
+
+Rows are ordered by id, and foreign keys (eg: article_topic, article_author)
+are stored as row indices into the corresponding arrays. String categories
+(age and household_income) are stored as integer codes into the vocabularies
+listed in the manifest.
+
+load_snapshot opens every array with memory mapping, so attaching to a game
+takes milliseconds whatever its size, and processes that open the same
+snapshot share its pages through the OS page cache.
+
+Snapshots are written with write_snapshot (or `cli.py snapshot`), once
+game_static has run.
+'''
+
+import json
+import os
+import shutil
+
+import numpy as np
+import sqlalchemy as sa
+
+import models as m
+import sparse
+
+FORMAT         = 'ba2-game-snapshot'
+FORMAT_VERSION = 2
+
+# Versions load_snapshot can read; version 1 snapshots have no sparse matrices
+SUPPORTED_VERSIONS = [1, 2]
+
+MANIFEST_FILE  = 'manifest.json'
+
+GAME_PARAMS    = ['id', 'name', 'seed', 'n_days', 'n_days_p0', 'n_authors', 'n_users',
+                  'sparse_top_k', 'sparse_threshold']
+
+# ------------------------
+# -  Section 1; writing  -
+# ------------------------
+
+class _Writer:
+    '''
+    Writes the arrays of a snapshot into a directory, and keeps track of
+    their description for the manifest
+    '''
+
+    def __init__(self, path):
+        self.path   = path
+        self.arrays = {}
+        self.sparse = {}
+
+    def save(self, name, values, dtype):
+        values = np.asarray(values, dtype=dtype)
+        np.save(os.path.join(self.path, f'{name}.npy'), values)
+        self._describe(name, values)
+
+    def matrix(self, name, shape, dtype):
+        '''
+        Returns a zero-filled array of the given shape that is memory mapped
+        to the snapshot file, so large matrices are filled in place
+        '''
+        out = np.lib.format.open_memmap(os.path.join(self.path, f'{name}.npy'),
+                                        mode='w+', dtype=dtype, shape=shape)
+        self._describe(name, out)
+        return out
+
+    def sparse_matrix(self, name, q, row_ids, col_ids):
+        '''
+        Saves the (row id, col id, value) rows returned by a query as a
+        sparse.SparseRows matrix; ids are translated into row indices with
+        row_ids and col_ids, which must be sorted
+        '''
+        with m.get_engine().connect() as con:
+            rows = con.execute(q).fetchall()
+        r, c, v = (np.array(x) for x in zip(*rows)) if rows else ([], [], [])
+        
+        matrix = sparse.SparseRows.from_coo(np.searchsorted(row_ids, r).astype(np.int64),
+                                            np.searchsorted(col_ids, c).astype(np.int64),
+                                            v, (len(row_ids), len(col_ids)))
+        self.sparse[name] = {'files' : matrix.save(self.path, name),
+                             'shape' : list(matrix.shape)}
+
+    def _describe(self, name, values):
+        self.arrays[name] = {'file'  : f'{name}.npy',
+                             'dtype' : values.dtype.str,
+                             'shape' : list(values.shape)}
+
+def _column(q):
+    '''
+    Runs a query returning rows of values, and returns a list of columns
+    '''
+    with m.get_engine().connect() as con:
+        rows = con.execute(q).fetchall()
+
+    return [list(c) for c in zip(*rows)] if rows else [[] for _ in q.selected_columns]
+
+def _fill(matrix, q, row_ids, col_ids, chunksize=100000):
+    '''
+    Fills matrix[row, col] = value from a query returning (row id, col id,
+    value) rows; ids are translated into row indices with row_ids and
+    col_ids, which must be sorted
+    '''
+    with m.get_engine().connect() as con:
+        result = con.execution_options(stream_results=True).execute(q)
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            r, c, v = (np.array(x) for x in zip(*rows))
+            matrix[np.searchsorted(row_ids, r), np.searchsorted(col_ids, c)] = v
+
+def _codes(values, vocabulary):
+    lookup = {v: i for i, v in enumerate(vocabulary)}
+    return [lookup.get(v, -1) for v in values]
+
+def write_snapshot(game_id, path):
+    '''
+    Writes a snapshot of a game to the directory path, replacing any
+    snapshot already there. The snapshot is written to a temporary
+    directory first, so readers never see a partial snapshot
+    '''
+
+    tmp_path = path.rstrip('/\\') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    w = _Writer(tmp_path)
+
+    with m.Session() as db:
+        game = db.get(m.Game, game_id)
+        game_params = {k: getattr(game, k) for k in GAME_PARAMS}
+    
+    is_sparse = (game_params['sparse_top_k'] is not None) or (game_params['sparse_threshold'] is not None)
+
+    # Topics
+    # ------
+    topic_id, topic_name = _column(sa.select(m.Topic.id, m.Topic.name)
+                                     .where(m.Topic.game_id == game_id)
+                                     .order_by(m.Topic.id))
+    w.save('topic_id', topic_id, np.int64)
+
+    # Authors
+    # -------
+    author_id, quality, productivity = _column(sa.select(m.Author.id, m.Author.quality, m.Author.productivity)
+                                                 .where(m.Author.game_id == game_id)
+                                                 .order_by(m.Author.id))
+    w.save('author_id', author_id, np.int64)
+    w.save('author_quality', quality, np.float64)
+    w.save('author_productivity', productivity, np.float64)
+
+    expertise_q = sa.select(m.AuthorTopic.author_id, m.AuthorTopic.topic_id, m.AuthorTopic.expertise) \
+                    .join(m.Author, m.Author.id == m.AuthorTopic.author_id) \
+                    .where(m.Author.game_id == game_id)
+    
+    if is_sparse:
+        w.sparse_matrix('author_expertise', expertise_q, author_id, topic_id)
+    else:
+        expertise = w.matrix('author_expertise', (len(author_id), len(topic_id)), np.float64)
+        _fill(expertise, expertise_q, author_id, topic_id)
+        expertise.flush()
+        del expertise
+
+    # Events
+    # ------
+    event_id, start, end, intensity = _column(sa.select(m.Event.id, m.Event.start, m.Event.end, m.Event.intensity)
+                                                .where(m.Event.game_id == game_id)
+                                                .order_by(m.Event.id))
+    w.save('event_id', event_id, np.int64)
+    w.save('event_start', start, np.int32)
+    w.save('event_end', end, np.int32)
+    w.save('event_intensity', intensity, np.float64)
+
+    relevance = w.matrix('event_relevance', (len(event_id), len(topic_id)), np.float64)
+    _fill(relevance,
+          sa.select(m.EventTopic.event_id, m.EventTopic.topic_id, m.EventTopic.relevance)
+            .join(m.Event, m.Event.id == m.EventTopic.event_id)
+            .where(m.Event.game_id == game_id),
+          event_id, topic_id)
+    relevance.flush()
+    del relevance
+
+    # Articles
+    # --------
+    article_id, day, a_topic, a_author, wordcount, vocab = _column(
+                        sa.select(m.Article.id, m.Article.day, m.Article.topic_id, m.Article.author_id,
+                                  m.Article.wordcount, m.Article.vocab)
+                          .where(m.Article.game_id == game_id)
+                          .order_by(m.Article.id))
+    w.save('article_id', article_id, np.int64)
+    w.save('article_day', day, np.int32)
+    w.save('article_topic', np.searchsorted(topic_id, a_topic), np.int32)
+    w.save('article_author', np.searchsorted(author_id, a_author), np.int32)
+    w.save('article_wordcount', wordcount, np.int32)
+    w.save('article_vocab', vocab, np.float64)
+
+    # Users
+    # -----
+    (user_id, freq, first_day, ad_sensitivity, ad_blocked, age, income,
+                    media_consumption, internet_usage_index) = _column(
+                        sa.select(m.User.id, m.User.freq, m.User.first_day, m.User.ad_sensitivity,
+                                  m.User.ad_blocked, m.User.age, m.User.household_income,
+                                  m.User.media_consumption, m.User.internet_usage_index)
+                          .where(m.User.game_id == game_id)
+                          .order_by(m.User.id))
+
+    categories = {'age'              : sorted(set(age) - {None}),
+                  'household_income' : sorted(set(income) - {None})}
+
+    w.save('user_id', user_id, np.int64)
+    w.save('user_freq', freq, np.int32)
+    w.save('user_first_day', first_day, np.int32)
+    w.save('user_ad_sensitivity', ad_sensitivity, np.float64)
+    w.save('user_ad_blocked', ad_blocked, np.bool_)
+    w.save('user_age', _codes(age, categories['age']), np.int16)
+    w.save('user_household_income', _codes(income, categories['household_income']), np.int16)
+    w.save('user_media_consumption', media_consumption, np.int32)
+    w.save('user_internet_usage_index', internet_usage_index, np.int32)
+
+    interest = w.matrix('user_interest', (len(user_id), len(topic_id)), np.float64)
+    _fill(interest,
+          sa.select(m.UserTopic.user_id, m.UserTopic.topic_id, m.UserTopic.interest)
+            .join(m.User, m.User.id == m.UserTopic.user_id)
+            .where(m.User.game_id == game_id),
+          user_id, topic_id)
+    interest.flush()
+    del interest
+
+    affinity_q = sa.select(m.UserAuthor.user_id, m.UserAuthor.author_id, m.UserAuthor.affinity) \
+                   .join(m.User, m.User.id == m.UserAuthor.user_id) \
+                   .where(m.User.game_id == game_id)
+
+    if is_sparse:
+        w.sparse_matrix('user_affinity', affinity_q, user_id, author_id)
+    else:
+        affinity = w.matrix('user_affinity', (len(user_id), len(author_id)), np.float64)
+        _fill(affinity, affinity_q, user_id, author_id)
+        affinity.flush()
+        del affinity
+
+    # Manifest
+    # --------
+    manifest = {'format'     : FORMAT,
+                'version'    : FORMAT_VERSION,
+                'game'       : game_params,
+                'topics'     : topic_name,
+                'categories' : categories,
+                'arrays'     : w.arrays,
+                'sparse'     : w.sparse}
+
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+    return path
+
+# ------------------------
+# -  Section 2; reading  -
+# ------------------------
+
+class Snapshot:
+    '''
+    A game snapshot opened by load_snapshot. Every array and sparse matrix
+    listed in the manifest is an attribute (eg: snapshot.user_interest), and
+      - game       : the game's parameters (id, name, seed, n_days, ...)
+      - topics     : the topic names, in topic row order
+      - categories : the vocabularies of the coded user columns
+    '''
+
+    def __init__(self, path, manifest, arrays):
+        self.path       = path
+        self.manifest   = manifest
+        self.game       = manifest['game']
+        self.topics     = manifest['topics']
+        self.categories = manifest['categories']
+
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    def __repr__(self):
+        return (f'<Snapshot of game {self.game["id"]}: {len(self.user_id)} users, '
+                f'{len(self.author_id)} authors, {len(self.article_id)} articles>')
+
+    def rows(self, kind, ids):
+        '''
+        Translates ids of a kind of object ('user', 'author', 'article',
+        'event' or 'topic') into row indices in the snapshot arrays
+        '''
+        all_ids = getattr(self, f'{kind}_id')
+        ids     = np.asarray(ids)
+        rows    = np.searchsorted(all_ids, ids)
+
+        assert np.all(all_ids[np.minimum(rows, len(all_ids) - 1)] == ids), f'Unknown {kind} id'
+
+        return rows
+
+    def decode(self, column, codes):
+        '''
+        Translates the integer codes of a coded user column (eg: 'age')
+        back into their values
+        '''
+        return np.asarray(self.categories[column], dtype=object)[np.asarray(codes)]
+
+def load_snapshot(path, mmap=True):
+    '''
+    Opens a snapshot written by write_snapshot. With mmap=True (the
+    default), arrays are memory mapped read-only rather than read into
+    memory
+    '''
+
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    assert manifest.get('format') == FORMAT, f'{path} is not a game snapshot'
+    assert manifest.get('version') in SUPPORTED_VERSIONS, \
+                f'Snapshot version {manifest.get("version")} is not supported (expected {FORMAT_VERSION})'
+
+    # Empty arrays can't be memory mapped
+    arrays = {name: np.load(os.path.join(path, a['file']),
+                            mmap_mode='r' if (mmap and np.prod(a['shape']) > 0) else None)
+                    for name, a in manifest['arrays'].items()}
+
+    for name, s in manifest.get('sparse', {}).items():
+        arrays[name] = sparse.SparseRows.load(path, s['files'], s['shape'][1], mmap=mmap)
+
+    return Snapshot(path, manifest, arrays)
@@ -0,0 +1,161 @@
+'''
+This file handles sparse storage of the concentrated Dirichlet vectors drawn in
+simulate_static - author expertises (alpha 0.3) and user affinities (alpha 0.4).
+With such small alphas, most of the mass of each vector sits on a handful of
+entries, and the rest are close to zero.
+
+When a game is generated with a sparse_top_k and/or a sparse_threshold, only
+the top-k entries of each vector (and/or those above the threshold) are kept
+and renormalized to sum to 1 (see top_k); the others are not stored at all.
+
+SparseRows is a compact CSR-style store for such vectors, one row per user
+(or author, or topic): the column indices and values of row i are
+indices[indptr[i]:indptr[i+1]] and data[indptr[i]:indptr[i+1]], with indices
+sorted within each row. Scoring code reads rows directly, without ever
+building the dense matrix.
+'''
+
+import os
+
+import numpy as np
+
+def top_k(values, k=None, threshold=None):
+    '''
+    Returns the (sorted) indices of the entries of values to keep, and
+    their values renormalized to sum to 1
+      - k         : keep at most the k largest entries
+      - threshold : keep only entries above threshold
+    The largest entry is always kept. If k and threshold are both None,
+    every entry is kept, unchanged
+    '''
+
+    values = np.asarray(values, dtype=float)
+
+    if (k is None) and (threshold is None):
+        return np.arange(len(values)), values
+
+    order = np.argsort(-values, kind='stable')
+    if k is not None:
+        order = order[:k]
+    if threshold is not None:
+        order = order[:max(1, int(np.sum(values[order] > threshold)))]
+
+    keep = np.sort(order)
+    kept = values[keep]
+
+    return keep, kept/kept.sum()
+
+class SparseRows:
+    '''
+    A CSR-style sparse matrix; see the top of this file
+    '''
+
+    def __init__(self, indptr, indices, data, n_cols):
+        self.indptr  = indptr
+        self.indices = indices
+        self.data    = data
+        self.shape   = (len(indptr) - 1, n_cols)
+
+    def __repr__(self):
+        return f'<SparseRows {self.shape[0]}x{self.shape[1]}, {len(self.data)} stored>'
+
+    @classmethod
+    def from_rows(cls, rows, n_cols):
+        '''
+        Builds a SparseRows from a list of (indices, values) pairs, one per
+        row; indices must be sorted
+        '''
+        lengths = [len(idx) for idx, _ in rows]
+        indptr  = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+
+        indices = np.concatenate([np.asarray(idx, dtype=np.int32) for idx, _ in rows]) \
+                        if rows else np.zeros(0, dtype=np.int32)
+        data    = np.concatenate([np.asarray(v, dtype=np.float64) for _, v in rows]) \
+                        if rows else np.zeros(0, dtype=np.float64)
+
+        return cls(indptr, indices, data, n_cols)
+
+    @classmethod
+    def from_coo(cls, rows, cols, values, shape):
+        '''
+        Builds a SparseRows from parallel arrays of row indices, column
+        indices and values (in any order)
+        '''
+        rows, cols, values = np.asarray(rows), np.asarray(cols), np.asarray(values, dtype=np.float64)
+
+        order  = np.lexsort((cols, rows))
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+
+        return cls(indptr, cols[order].astype(np.int32), values[order], shape[1])
+
+    @classmethod
+    def from_dense(cls, matrix, k=None, threshold=None):
+        '''
+        Builds a SparseRows from a dense matrix, keeping the entries of each
+        row selected by top_k
+        '''
+        return cls.from_rows([top_k(row, k, threshold) for row in np.asarray(matrix)],
+                             np.shape(matrix)[1])
+
+    def row(self, i):
+        '''
+        Returns the column indices and values stored in row i
+        '''
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def get(self, i, j, default=0.0):
+        '''
+        Returns the value at row i and column j, or default if it isn't
+        stored
+        '''
+        idx, values = self.row(i)
+        pos = np.searchsorted(idx, j)
+
+        if pos < len(idx) and idx[pos] == j:
+            return values[pos]
+
+        return default
+
+    def dense_row(self, i):
+        out = np.zeros(self.shape[1])
+        idx, values = self.row(i)
+        out[idx] = values
+        return out
+
+    def to_dense(self):
+        out  = np.zeros(self.shape)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        out[rows, self.indices] = self.data
+        return out
+
+    def transpose(self):
+        '''
+        Returns the same matrix with rows and columns swapped (eg: turns
+        author x topic expertises into topic x author)
+        '''
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return SparseRows.from_coo(self.indices, rows, self.data, (self.shape[1], self.shape[0]))
+
+    def save(self, path, name):
+        '''
+        Saves the matrix as three .npy files in the directory path, and
+        returns their names
+        '''
+        files = {}
+        for part in ['indptr', 'indices', 'data']:
+            files[part] = f'{name}.{part}.npy'
+            np.save(os.path.join(path, files[part]), getattr(self, part))
+        return files
+
+    @classmethod
+    def load(cls, path, files, n_cols, mmap=True):
+        parts = {}
+        for part, file in files.items():
+            size = os.path.getsize(os.path.join(path, file))
+            # Empty arrays can't be memory mapped
+            parts[part] = np.load(os.path.join(path, file),
+                                  mmap_mode='r' if (mmap and size > 128) else None)
+        return cls(parts['indptr'], parts['indices'], parts['data'], n_cols)
@@ -0,0 +1,114 @@
+'''
+This file compiles the strategies of a team into vectorized rules, so that the
+strategy applying to each of a day's pageviews is found in one pass rather than
+with one Team.get_strategy_for_user call per pageview.
+
+A strategy applies to a pageview if its segment matches the user and article
+(see models.Strategy): a segment maps attributes (SEGMENT_ATTRIBUTES) to the
+list of values it covers, and a strategy with no segment applies to every
+pageview. When several strategies apply, the one with the highest priority
+wins, and among those, the most recent (highest id) - so that a team's latest
+unsegmented strategy replaces its previous one, as it always has.
+
+Compiled rules are cached per team, keyed on the content of the team's
+strategies: adding or changing a strategy invalidates them.
+'''
+
+import json
+
+import numpy as np
+
+# Attributes a segment can filter on, and the object they are read from
+SEGMENT_ATTRIBUTES = {'age'              : 'user',
+                      'household_income' : 'user',
+                      'topic_id'         : 'article'}
+
+def check_segment(segment):
+    '''
+    Raises a ValueError unless segment is a valid segment: None, or a
+    dictionary mapping attributes of SEGMENT_ATTRIBUTES to lists of values
+    '''
+    if segment is None:
+        return
+    if not isinstance(segment, dict):
+        raise ValueError(f'A segment must be a dictionary, not {segment!r}')
+    for attr, allowed in segment.items():
+        if attr not in SEGMENT_ATTRIBUTES:
+            raise ValueError(f'Strategies cannot be segmented on {attr}')
+        if not isinstance(allowed, (list, tuple)):
+            raise ValueError(f'The values of segment attribute {attr} must be a list')
+
+def segment_matches(segment, user, article):
+    '''
+    Returns True if a segment matches a single user and article; this is
+    the scalar version of CompiledRules.assign
+    '''
+    objects = {'user': user, 'article': article}
+    return all(getattr(objects[SEGMENT_ATTRIBUTES[attr]], attr) in allowed
+                    for attr, allowed in (segment or {}).items())
+
+def precedence(strategy):
+    return (strategy.priority or 0, strategy.id)
+
+def signature(strategies):
+    '''
+    Returns a hashable summary of everything in a list of strategies that
+    affects their compiled rules
+    '''
+    return tuple((s.id, s.priority, json.dumps(s.segment, sort_keys=True), s.cost, s.ads, s.free_pvs)
+                        for s in strategies)
+
+class CompiledRules:
+    '''
+    The strategies of a team compiled into arrays
+      - strategies : the strategies, from lowest to highest precedence
+      - ids, cost, ads, free_pvs : the corresponding arrays
+    assign returns indices into these
+    '''
+
+    def __init__(self, strategies):
+        for attr in set().union(*[(s.segment or {}).keys() for s in strategies]):
+            assert attr in SEGMENT_ATTRIBUTES, f'Strategies cannot be segmented on {attr}'
+
+        self.strategies = sorted(strategies, key=precedence)
+        self.segments   = [s.segment or {} for s in self.strategies]
+
+        self.ids        = np.array([s.id for s in self.strategies], dtype=np.int64)
+        self.cost       = np.array([s.cost for s in self.strategies], dtype=np.float64)
+        self.ads        = np.array([s.ads for s in self.strategies], dtype=np.int64)
+        self.free_pvs   = np.array([s.free_pvs for s in self.strategies], dtype=np.int64)
+
+    def assign(self, columns):
+        '''
+        Given columns, a dictionary mapping each of SEGMENT_ATTRIBUTES to an
+        array with one value per pageview, returns the index of the strategy
+        applying to each pageview
+        '''
+        n   = len(next(iter(columns.values())))
+        out = np.full(n, -1, dtype=np.int64)
+
+        # Strategies are in increasing precedence, so later matches win
+        for i, segment in enumerate(self.segments):
+            mask = np.ones(n, dtype=bool)
+            for attr, allowed in segment.items():
+                mask &= np.isin(columns[attr], np.asarray(allowed, dtype=columns[attr].dtype))
+            out[mask] = i
+
+        assert np.all(out >= 0), 'Some pageviews match none of the strategies of the team'
+
+        return out
+
+_compiled = {}
+
+def compiled(team_id, strategies):
+    '''
+    Returns the CompiledRules of a team's strategies, compiling them only if
+    they changed since the last call
+    '''
+    sig = signature(strategies)
+
+    cached = _compiled.get(team_id)
+    if (cached is None) or (cached[0] != sig):
+        cached = _compiled[team_id] = (sig, CompiledRules(strategies))
+
+    return cached[1]
@@ -0,0 +1,265 @@
+'''
+This file is a Monte Carlo sweep engine, meant to calibrate the game by trying
+many strategies (cost, ads, free_pvs) without a full generate_pvs run for each.
+
+A sweep runs against a game snapshot (see snapshot.py) and the game's visit
+calendar (see visits.py), for a single team. It relies on the fact that, in
+simulate_dynamic, which articles a user reads does not depend on the team's
+strategy - only the ads shown, the paywall hits and the conversions do. Each
+replicate therefore
+  1. simulates every session of the calendar once, with the same click model
+     as SessionSimulator.simulate_session (including author popularity,
+     which starts from no pageviews), recording for every session its
+     user, its number of pageviews, and the user's prior pageviews and
+     sessions
+  2. evaluates every strategy of the grid on those sessions at once, as
+     (strategies x sessions) arrays: paywall hits, then conversions with the
+     logistic model of simulate_dynamic.conversion_probability, using the
+     same uniform draw for a given session under every strategy (common
+     random numbers, so that differences between strategies are not drowned
+     in noise)
+
+Replicates use independent random streams (numpy Generators seeded from the
+sweep seed and the replicate number), and run in parallel on a process pool;
+every worker memory-maps the same snapshot.
+
+sweep returns, for every strategy and replicate, the pageviews, ads served,
+paywall hits, conversions and revenue (as in rollups.METRICS); summarize turns
+them into a table of means, standard deviations and 5%/95% quantiles.
+
+Usage
+    python sweep.py --snapshot snapshots/game_1
+    python sweep.py --costs 5,9,15 --ads 0,3,6 --free-pvs 3,6,12,24 --replicates 16 --output sweep.csv
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+
+METRICS = ['pageviews', 'ads_served', 'paywall_hits', 'conversions', 'revenue']
+
+DEFAULT_GRID = {'cost'     : [5, 9, 15],
+                'ads'      : [0, 3, 6],
+                'free_pvs' : [3, 6, 12, 24]}
+
+def strategy_grid(cost, ads, free_pvs):
+    '''
+    Returns every combination of the given costs, ads and free_pvs, as a
+    list of dictionaries
+    '''
+    return [{'cost': c, 'ads': a, 'free_pvs': f} for c, a, f in itertools.product(cost, ads, free_pvs)]
+
+# ---------------------------
+# -  Section 1; sessions    -
+# ---------------------------
+
+def simulate_sessions(snap, calendar, start, end, rng):
+    '''
+    Simulates the sessions of every visit in the calendar between days
+    start and end (excluded), and returns a dictionary of arrays with one
+    entry per session, in chronological order
+      - user           : the user's row in the snapshot
+      - n_pvs          : the number of pageviews in the session
+      - prior_pvs      : the user's pageviews in their previous sessions
+      - prior_sessions : the user's number of previous sessions
+    Previous sessions are those of the trailing window, as in PVCache
+    '''
+    import compaction
+    import popularity
+    import simulate_dynamic as sd
+
+    quality = snap.author_quality[snap.article_author] * sd.QUALITY_WEIGHT
+    # user -> (day, articles clicked) of their sessions in the trailing window
+    history = collections.defaultdict(collections.deque)
+
+    # The team's author popularity, starting from no pageviews
+    pop = popularity.Popularity(snap.author_id)
+
+    out = {k: [] for k in ['user', 'n_pvs', 'prior_pvs', 'prior_sessions']}
+
+    for day in range(start, end):
+        # Articles users might see today; see generate_pvs
+        active   = (snap.event_start <= day) & (snap.event_end >= day)
+        longtail = snap.event_start[active].min() if active.any() else day
+        window   = np.flatnonzero((snap.article_day >= longtail) & (snap.article_day <= day))
+        topics   = snap.article_topic[window]
+        boost    = pop.shares()[snap.article_author[window]] * sd.POPULARITY_WEIGHT
+        clicks   = []
+
+        for u in snap.rows('user', calendar.visitors(day)):
+            sessions = history[u]
+            while sessions and sessions[0][0] < day - compaction.TRAILING_DAYS:
+                sessions.popleft()
+            past = [a for d, a in sessions]
+            seen = np.concatenate(past) if past else np.zeros(0, dtype=np.int64)
+
+            order  = rng.permutation(len(window))
+            order  = order[~np.isin(window[order], seen)]
+            scores = snap.user_interest[u, topics[order]] * sd.INTEREST_WEIGHT + quality[window[order]] + boost[order]
+
+            # Go through the articles in order, clicking those above the
+            # cutoff, which rises with every click
+            clicked = []
+            cutoff  = sd.SCORE_AVERAGE + sd.SCORE_STDDEV
+            pos     = 0
+            while pos < len(scores):
+                above = np.flatnonzero(scores[pos:] > cutoff)
+                if not len(above):
+                    break
+                pos += above[0]
+                clicked.append(window[order[pos]])
+                cutoff += sd.SCORE_STDDEV * sd.CLICK_STEP
+                pos += 1
+
+            out['user'].append(u)
+            out['n_pvs'].append(len(clicked))
+            out['prior_pvs'].append(sum(len(s) for s in past))
+            out['prior_sessions'].append(len(past))
+
+            sessions.append((day, np.array(clicked, dtype=np.int64)))
+            clicks.extend(clicked)
+
+        pop.add_day(snap.author_id[snap.article_author[np.array(clicks, dtype=np.int64)]])
+
+    return {k: np.array(v, dtype=np.int64) for k, v in out.items()}
+
+# ---------------------------
+# -  Section 2; strategies  -
+# ---------------------------
+
+def evaluate(snap, sessions, strategies, u):
+    '''
+    Evaluates every strategy on the same sessions. u holds one uniform
+    draw per session, shared by every strategy. Returns a dictionary
+    mapping each of METRICS to an array with one value per strategy
+    '''
+    import simulate_dynamic as sd
+
+    cost     = np.array([s['cost'] for s in strategies], dtype=float)
+    ads      = np.array([s['ads'] for s in strategies], dtype=float)
+    free_pvs = np.array([s['free_pvs'] for s in strategies])
+
+    user     = sessions['user']
+    n_pvs    = sessions['n_pvs']
+    n_sess   = len(user)
+    n_users  = len(snap.user_id)
+
+    income = np.array([sd.income_value(v) for v in snap.decode('household_income', snap.user_household_income)],
+                      dtype=float) if n_users else np.zeros(0)
+    p = sd.conversion_probability(income[user], snap.user_ad_sensitivity[user], sessions['prior_sessions'])
+
+    # Sessions with pageviews past each strategy's free pageviews hit the
+    # paywall, unless the user already subscribed
+    eligible  = (n_pvs > 0)[None, :] & (sessions['prior_pvs'][None, :] >= free_pvs[:, None])
+    converts  = eligible & (u < p)[None, :]
+
+    # First converting session of each user, under each strategy
+    first = np.full((len(strategies), n_users), n_sess)
+    s_idx, i_idx = np.nonzero(converts)
+    np.minimum.at(first, (s_idx, user[i_idx]), i_idx)
+
+    # The converting session still sees the paywall; later ones don't
+    hits = eligible & (np.arange(n_sess)[None, :] <= first[:, user])
+
+    conversions = (first < n_sess).sum(axis=1)
+
+    return {'pageviews'    : np.full(len(strategies), n_pvs.sum(), dtype=float),
+            'ads_served'   : n_pvs.sum() * ads,
+            'paywall_hits' : (hits * n_pvs[None, :]).sum(axis=1).astype(float),
+            'conversions'  : conversions.astype(float),
+            'revenue'      : conversions * cost}
+
+def run_replicate(snapshot_path, calendar, strategies, start, end, seed, replicate):
+    '''
+    Runs one replicate of a sweep; see the top of this file
+    '''
+    import snapshot
+
+    snap = snapshot.load_snapshot(snapshot_path)
+    rng  = np.random.default_rng([seed, replicate])
+
+    sessions = simulate_sessions(snap, calendar, start, end, rng)
+
+    return evaluate(snap, sessions, strategies, rng.uniform(size=len(sessions['user'])))
+
+def sweep(snapshot_path, strategies, n_replicates=8, start=0, end=None, seed=0, workers=None):
+    '''
+    Evaluates every strategy in strategies (dictionaries with a cost, ads
+    and free_pvs; see strategy_grid) against a game snapshot, over
+    n_replicates replicates, using up to workers processes (by default,
+    one per CPU). Returns a dictionary mapping each of METRICS to an
+    array of shape (strategies, replicates)
+    '''
+    import snapshot
+    import visits
+
+    snap = snapshot.load_snapshot(snapshot_path)
+    if end is None:
+        end = snap.game['n_days']
+
+    calendar = visits.draw_calendar(snap.game['seed'], snap.user_id, snap.user_freq, snap.user_first_day, end)
+
+    args = [(snapshot_path, calendar, strategies, start, end, seed, r) for r in range(n_replicates)]
+
+    if workers == 1:
+        results = [run_replicate(*a) for a in args]
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=ctx) as pool:
+            results = list(pool.map(run_replicate, *zip(*args)))
+
+    return {k: np.stack([r[k] for r in results], axis=1) for k in METRICS}
+
+def summarize(strategies, results):
+    '''
+    Returns a DataFrame with a row per strategy, and the mean, standard
+    deviation and 5% and 95% quantiles of each of METRICS over replicates
+    '''
+    import pandas as pd
+
+    df = pd.DataFrame(strategies)
+    for k in METRICS:
+        df[f'{k}_mean'] = results[k].mean(axis=1)
+        df[f'{k}_std']  = results[k].std(axis=1)
+        df[f'{k}_p5']   = np.quantile(results[k], 0.05, axis=1)
+        df[f'{k}_p95']  = np.quantile(results[k], 0.95, axis=1)
+
+    return df.sort_values('revenue_mean', ascending=False, ignore_index=True)
+
+def main():
+    def ints(s):
+        return [int(x) for x in s.split(',')]
+
+    def floats(s):
+        return [float(x) for x in s.split(',')]
+
+    parser = argparse.ArgumentParser(description='Monte Carlo sweep of strategies over a game snapshot')
+    parser.add_argument('--snapshot', default='snapshots/game_1', help='Snapshot of the game (see cli.py snapshot)')
+    parser.add_argument('--costs', type=floats, default=DEFAULT_GRID['cost'], help='Comma-separated costs')
+    parser.add_argument('--ads', type=ints, default=DEFAULT_GRID['ads'], help='Comma-separated ads per pageview')
+    parser.add_argument('--free-pvs', type=ints, default=DEFAULT_GRID['free_pvs'], help='Comma-separated free pageviews')
+    parser.add_argument('--replicates', type=int, default=8, help='Number of random replicates')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: one per CPU)')
+    parser.add_argument('--start', type=int, default=0, help='First day to simulate')
+    parser.add_argument('--end', type=int, default=None, help='Day to stop simulating at (default: end of the game)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sweep')
+    parser.add_argument('--output', default=None, help='CSV file to write the summary to')
+    args = parser.parse_args()
+
+    strategies = strategy_grid(args.costs, args.ads, args.free_pvs)
+    results    = sweep(args.snapshot, strategies, args.replicates, args.start, args.end, args.seed, args.workers)
+    df         = summarize(strategies, results)
+
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+    cols = ['cost', 'ads', 'free_pvs'] + [f'{k}_mean' for k in METRICS] + ['revenue_std']
+    print(df[cols].to_string(index=False))
+
+if __name__ == '__main__':
+    main()
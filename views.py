@@ -0,0 +1,194 @@
+'''
+This file provides read-only views of the objects the simulation loops over -
+articles, authors, events, users and strategies.
+
+The hot loops in simulate_static and simulate_dynamic read attributes such as
+article.author.quality, event.intensity or user.freq millions of times. On ORM
+instances, every such read goes through SQLAlchemy's instrumented descriptors
+(and possibly a lazy load). Views are plain objects with __slots__, detached
+from any session
+  - they are built in bulk from a handful of column queries (see the load_
+    functions below), rather than one ORM instance at a time
+  - attribute reads are plain slot reads
+  - they take a fraction of the memory of an ORM instance (no __dict__, no
+    instance state)
+
+Views are read-only; writes (new articles, pageviews, subscriptions, ...) still
+go through the ORM classes in models, using the ids held by the views.
+'''
+
+import sqlalchemy as sa
+
+import models as m
+
+class _View:
+    '''
+    Base class for views; subclasses list their attributes in __slots__,
+    and are built with the values of those attributes, in order
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.id}>'
+
+class AuthorView(_View):
+    __slots__ = ('id', 'name', 'quality', 'productivity')
+
+class ArticleView(_View):
+    '''
+    An article; author is the AuthorView of its author
+    '''
+    __slots__ = ('id', 'day', 'topic_id', 'author_id', 'wordcount', 'vocab', 'author')
+
+class EventView(_View):
+    '''
+    An event; topic_ids and relevances are parallel tuples listing the
+    event's topic relevances (see models.EventTopic), in topic id order
+    '''
+    __slots__ = ('id', 'start', 'end', 'intensity', 'topic_ids', 'relevances')
+
+class UserView(_View):
+    '''
+    A user
+      - interests     : dictionary mapping topic ids to interests
+      - affinities    : dictionary mapping author ids to affinities (empty
+                        unless loaded with affinities=True)
+      - subscriptions : frozenset of the ids of the teams the user had an
+                        active subscription to when the view was loaded
+    '''
+    __slots__ = ('id', 'freq', 'first_day', 'ad_sensitivity', 'ad_blocked', 'age', 'household_income',
+                 'media_consumption', 'internet_usage_index', 'interests', 'affinities', 'subscriptions')
+
+class StrategyView(_View):
+    __slots__ = ('id', 'team_id', 'cost', 'ads', 'free_pvs', 'segment', 'priority')
+
+# ---------------------
+# -  Bulk loading     -
+# ---------------------
+
+def load_authors(db, game_id):
+    '''
+    Returns a dictionary mapping author ids to AuthorViews, for every
+    author of a game
+    '''
+    q = sa.select(m.Author.id, m.Author.name, m.Author.quality, m.Author.productivity) \
+          .where(m.Author.game_id == game_id)
+
+    return {row[0]: AuthorView(*row) for row in db.execute(q)}
+
+def load_articles(db, game_id, start=None, end=None, authors=None):
+    '''
+    Returns the ArticleViews of a game, in id order, optionally only those
+    published between days start and end (inclusive). authors is the
+    result of load_authors; it is loaded if not given
+    '''
+    if authors is None:
+        authors = load_authors(db, game_id)
+
+    q = sa.select(m.Article.id, m.Article.day, m.Article.topic_id, m.Article.author_id,
+                  m.Article.wordcount, m.Article.vocab) \
+          .where(m.Article.game_id == game_id) \
+          .order_by(m.Article.id)
+
+    if start is not None:
+        q = q.where(m.Article.day >= start)
+    if end is not None:
+        q = q.where(m.Article.day <= end)
+
+    return [ArticleView(*row, authors.get(row[3])) for row in db.execute(q)]
+
+def load_events(db, game_id, day=None):
+    '''
+    Returns the EventViews of a game, in id order, optionally only those
+    that can still lead to an article on a given day
+    '''
+    q = sa.select(m.Event.id, m.Event.start, m.Event.end, m.Event.intensity) \
+          .where(m.Event.game_id == game_id) \
+          .order_by(m.Event.id)
+
+    if day is not None:
+        q = q.where(m.Event.start <= day).where(m.Event.end >= day)
+
+    events = db.execute(q).fetchall()
+
+    # Topic relevances of those events
+    relevances = {}
+    q = sa.select(m.EventTopic.event_id, m.EventTopic.topic_id, m.EventTopic.relevance) \
+          .where(m.EventTopic.event_id.in_(q.with_only_columns(m.Event.id).order_by(None))) \
+          .order_by(m.EventTopic.event_id, m.EventTopic.topic_id)
+
+    for event_id, topic_id, relevance in db.execute(q):
+        topic_ids, values = relevances.setdefault(event_id, ([], []))
+        topic_ids.append(topic_id)
+        values.append(relevance)
+
+    return [EventView(*row, *(tuple(x) for x in relevances.get(row[0], ([], []))))
+                for row in events]
+
+def load_users(db, game_id, day=None, affinities=False):
+    '''
+    Returns the UserViews of a game, in id order, optionally only those who
+    can visit on a given day (i.e., whose first_day is on or before it).
+    Author affinities are only loaded if affinities is True
+    '''
+    user_ids = sa.select(m.User.id).where(m.User.game_id == game_id)
+    if day is not None:
+        user_ids = user_ids.where(m.User.first_day <= day)
+
+    def by_user(q):
+        out = {}
+        for user_id, key, value in db.execute(q):
+            out.setdefault(user_id, {})[key] = value
+        return out
+
+    interests = by_user(sa.select(m.UserTopic.user_id, m.UserTopic.topic_id, m.UserTopic.interest)
+                          .where(m.UserTopic.user_id.in_(user_ids)))
+
+    author_affinities = {}
+    if affinities:
+        author_affinities = by_user(sa.select(m.UserAuthor.user_id, m.UserAuthor.author_id, m.UserAuthor.affinity)
+                                      .where(m.UserAuthor.user_id.in_(user_ids)))
+
+    subscriptions = {}
+    q = sa.select(m.UserStrategy.user_id, m.Strategy.team_id) \
+          .join(m.Strategy, m.Strategy.id == m.UserStrategy.strategy_id) \
+          .where(m.UserStrategy.user_id.in_(user_ids)) \
+          .where(m.UserStrategy.end_day == None)
+    for user_id, team_id in db.execute(q):
+        subscriptions.setdefault(user_id, set()).add(team_id)
+
+    q = sa.select(m.User.id, m.User.freq, m.User.first_day, m.User.ad_sensitivity, m.User.ad_blocked,
+                  m.User.age, m.User.household_income, m.User.media_consumption,
+                  m.User.internet_usage_index) \
+          .where(m.User.id.in_(user_ids)) \
+          .order_by(m.User.id)
+
+    return [UserView(*row,
+                     interests.get(row[0], {}),
+                     author_affinities.get(row[0], {}),
+                     frozenset(subscriptions.get(row[0], ())))
+                for row in db.execute(q)]
+
+def load_strategies(db, game_id):
+    '''
+    Returns a dictionary mapping the id of every team of a game to the list
+    of its StrategyViews, in id order
+    '''
+    q = sa.select(m.Strategy.id, m.Strategy.team_id, m.Strategy.cost, m.Strategy.ads, m.Strategy.free_pvs,
+                  m.Strategy.segment, m.Strategy.priority) \
+          .join(m.Team, m.Team.id == m.Strategy.team_id) \
+          .where(m.Team.game_id == game_id) \
+          .order_by(m.Strategy.id)
+
+    out = {}
+    for row in db.execute(q):
+        out.setdefault(row[1], []).append(StrategyView(*row))
+    return out
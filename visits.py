@@ -0,0 +1,127 @@
+'''
+This file schedules user visits. Rather than running a session for every user
+on every day, the visit calendar decides up front which users visit on which
+days, and the dynamic simulation (simulate_dynamic.generate_pvs) only runs
+sessions for those users.
+
+A user's freq is the expected number of days on which they visit the site over
+VISIT_PERIOD days, so on any day from their first_day onwards, a user visits
+with probability min(1, freq/VISIT_PERIOD). With freq drawn around 5 (see
+simulate_static.user_freq), about one user in six visits on a given day.
+
+The calendar is drawn from its own seeded stream (VisitStream), derived from
+the game's seed, with one vectorized draw over every user per day. It therefore
+only depends on the game, never on the teams or on the order in which days are
+simulated; simulating days 0-30 and then 30-60 gives the same visits as
+simulating days 0-60 at once.
+
+The calendar is stored as a sparse users x days matrix, with the visitors of
+each day held as a sorted array of user ids: the visitors of day d are
+user_ids[indptr[d]:indptr[d+1]].
+'''
+
+import numpy as np
+import sqlalchemy as sa
+
+import models as m
+import rand_utils
+
+VISIT_PERIOD = 30
+
+# Offset added to the game seed to seed the visit stream, so that visits
+# are not drawn from the same sequence as the game itself
+SEED_OFFSET  = 7919
+
+class VisitStream(rand_utils.Rand_utils_mixin):
+    '''
+    A random stream seeded from a game's seed (see rand_utils)
+    '''
+
+    def __init__(self, game_seed):
+        self.seed         = (game_seed + SEED_OFFSET) % 2**32
+        self.random_state = ''
+
+class VisitCalendar:
+    '''
+    The visit calendar of a game; see the top of this file
+    '''
+
+    def __init__(self, indptr, user_ids):
+        self.indptr   = indptr
+        self.user_ids = user_ids
+
+    def __repr__(self):
+        return f'<VisitCalendar {self.n_days} days, {len(self.user_ids)} visits>'
+
+    @property
+    def n_days(self):
+        return len(self.indptr) - 1
+
+    def visitors(self, day):
+        '''
+        Returns the sorted ids of the users who visit on a given day
+        '''
+        return self.user_ids[self.indptr[day]:self.indptr[day + 1]]
+
+    def n_visitors(self):
+        '''
+        Returns the number of visitors on each day
+        '''
+        return np.diff(self.indptr)
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, user_ids=self.user_ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['indptr'], f['user_ids'])
+
+def visit_probabilities(freq):
+    return np.minimum(1, np.maximum(0, np.asarray(freq, dtype=float))/VISIT_PERIOD)
+
+def build_calendar(game_id, n_days=None):
+    '''
+    Draws the visit calendar of a game for days 0 to n_days - 1 (by
+    default, every day of the game)
+    '''
+
+    with m.Session() as db:
+        game = db.get(m.Game, game_id)
+        seed = game.seed
+        if n_days is None:
+            n_days = game.n_days
+
+        q = sa.select(m.User.id, m.User.freq, m.User.first_day) \
+              .where(m.User.game_id == game_id) \
+              .order_by(m.User.id)
+        rows = db.execute(q).fetchall()
+
+    user_ids, freq, first_day = (list(c) for c in zip(*rows)) if rows else ([], [], [])
+
+    return draw_calendar(seed, user_ids, freq, first_day, n_days)
+
+def draw_calendar(game_seed, user_ids, freq, first_day, n_days):
+    '''
+    Draws a visit calendar from the users' ids (sorted), freq and first_day
+    columns, eg: those of a snapshot; see build_calendar
+    '''
+
+    user_ids  = np.asarray(user_ids, dtype=np.int64)
+    first_day = np.asarray(first_day, dtype=np.int64)
+    p         = visit_probabilities(freq)
+
+    stream = VisitStream(int(game_seed))
+
+    indptr = np.zeros(n_days + 1, dtype=np.int64)
+    days   = []
+    for day in range(n_days):
+        # One draw per user per day, whether or not they can visit yet,
+        # so that every day uses the same number of draws
+        u = stream.generate_rv('uniform', n=len(user_ids)) if len(user_ids) else np.zeros(0)
+
+        visitors = user_ids[(u < p) & (first_day <= day)]
+        days.append(visitors)
+        indptr[day + 1] = indptr[day] + len(visitors)
+
+    return VisitCalendar(indptr, np.concatenate(days) if days else np.zeros(0, dtype=np.int64))